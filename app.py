@@ -1,15 +1,30 @@
 import os
 import json
 import time
-from typing import List, Dict, Any, Optional
-
-from flask import Flask, jsonify, request, send_from_directory
+import threading
+import queue
+import itertools
+import math
+import random
+from statistics import NormalDist
+from collections import OrderedDict, deque
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 
 import yfinance as yf
+import numpy as np
 import pandas as pd
-import urllib.request
-import urllib.error
+import http.client
+import urllib.parse
+
+try:
+    import orjson  # optional: much faster JSON encoding for large history payloads
+except ImportError:
+    orjson = None
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 WATCHLIST_PATH = os.path.join(APP_DIR, "watchlist.json")
@@ -63,6 +78,147 @@ def _save_watchlist(symbols: List[str]) -> None:
         print(f"Failed to save watchlist: {e}")
 
 
+# ----------------------
+# 进程级 TTL 缓存（行情等上游数据）
+# ----------------------
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ``ttl`` seconds.
+
+    Shared by every request thread so that N clients polling the same symbols
+    cost one upstream fetch per key per TTL window.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 512, name: str = "cache", stale_ttl: float = 0.0):
+        self.ttl = float(ttl)
+        # 过期后仍保留 stale_ttl 秒，供 get_stale 做 stale-while-revalidate
+        self.stale_ttl = float(stale_ttl)
+        self.maxsize = int(maxsize)
+        self.name = name
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: Dict[Any, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self._lookup(key, default, count=True)
+
+    def _lookup(self, key: Any, default: Any, count: bool) -> Any:
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += count
+                return default
+            stored_at, value = item
+            if now - stored_at > self.ttl:
+                if now - stored_at > self.ttl + self.stale_ttl:
+                    del self._data[key]
+                    self.expirations += 1
+                self.misses += count
+                return default
+            self._data.move_to_end(key)
+            self.hits += count
+            return value
+
+    def get_stale(self, key: Any, default: Any = None) -> Any:
+        """Return an expired entry that is still within the stale window, without counting a lookup."""
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or now - item[0] > self.ttl + self.stale_ttl:
+                return default
+            return item[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key: Any, loader: Callable[[], Any], cache_if: Optional[Callable[[Any], bool]] = None) -> Any:
+        """Return the cached value or run ``loader`` once for all concurrent callers of ``key``.
+
+        Callers arriving while a load is in flight receive that load's result (or
+        exception) even when ``cache_if`` rejects it, so a failing upstream is hit
+        once per burst rather than once per waiter.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = Future()
+        if not leader:
+            return flight.result()
+        try:
+            # 等锁期间可能已有上一轮加载写入缓存
+            value = self._lookup(key, _MISSING, count=False)
+            if value is _MISSING:
+                value = loader()
+                if cache_if is None or cache_if(value):
+                    self.set(key, value)
+            flight.set_result(value)
+            return value
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# 行情缓存：默认 15 秒与前端轮询周期一致，可通过环境变量调整
+QUOTE_CACHE_TTL = float(os.environ.get("QUOTE_CACHE_TTL", 15))
+QUOTE_CACHE_SIZE = int(os.environ.get("QUOTE_CACHE_SIZE", 1024))
+QUOTE_STALE_TTL = float(os.environ.get("QUOTE_STALE_TTL", 300))
+_quote_cache = TTLCache(QUOTE_CACHE_TTL, QUOTE_CACHE_SIZE, name="quotes", stale_ttl=QUOTE_STALE_TTL)
+
+# 上游抓取线程池：限制并发避免被限流；超时的代码返回 error 字段而不阻塞整个响应
+QUOTE_FETCH_WORKERS = int(os.environ.get("QUOTE_FETCH_WORKERS", 8))
+QUOTE_FETCH_TIMEOUT = float(os.environ.get("QUOTE_FETCH_TIMEOUT", 10))
+_fetch_executor = ThreadPoolExecutor(max_workers=QUOTE_FETCH_WORKERS, thread_name_prefix="quote-fetch")
+
+
+def _index_ms(index: pd.Index) -> np.ndarray:
+    """Epoch milliseconds for a DatetimeIndex in one vectorized step (independent of its resolution)."""
+    idx = pd.DatetimeIndex(index)
+    return ((idx - pd.Timestamp(0, tz=idx.tz)) // pd.Timedelta(1, "ms")).to_numpy(dtype=np.int64)
+
+
 def _safe_get(fi: Any, key: str) -> Optional[Any]:
     try:
         if fi is None:
@@ -73,64 +229,727 @@ def _safe_get(fi: Any, key: str) -> Optional[Any]:
         return None
 
 
-def _compute_indicators(close: pd.Series) -> Dict[str, Any]:
-    indicators: Dict[str, Any] = {
+# ----------------------
+# 技术指标引擎（symbols × bars 二维向量化计算，行情与历史接口共用）
+# ----------------------
+INDICATOR_KEYS = ("sma20", "sma50", "rsi14", "macd", "macd_signal", "macd_hist", "bb_upper", "bb_middle", "bb_lower")
+
+
+def _close_matrix(closes: List[Any]) -> np.ndarray:
+    """Stack close series into a symbols x bars float matrix, right-aligned and NaN-padded on the left."""
+    rows = [np.asarray(c, dtype=float) for c in closes]
+    width = max((len(r) for r in rows), default=0)
+    mat = np.full((len(rows), width), np.nan)
+    for i, r in enumerate(rows):
+        if len(r):
+            mat[i, width - len(r):] = r
+    return mat
+
+
+def _rolling_sum(x: np.ndarray, window: int) -> np.ndarray:
+    """Trailing window sum along axis 1; NaN until ``window`` valid values are available (pandas min_periods)."""
+    n, t = x.shape
+    out = np.full((n, t), np.nan)
+    if t < window:
+        return out
+    valid = ~np.isnan(x)
+    zeros = np.zeros((n, 1))
+    csum = np.concatenate([zeros, np.cumsum(np.where(valid, x, 0.0), axis=1)], axis=1)
+    ccnt = np.concatenate([zeros, np.cumsum(valid, axis=1)], axis=1)
+    sums = csum[:, window:] - csum[:, :-window]
+    counts = ccnt[:, window:] - ccnt[:, :-window]
+    out[:, window - 1:] = np.where(counts == window, sums, np.nan)
+    return out
+
+
+def _rolling_mean_std(x: np.ndarray, window: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Trailing mean and sample std (ddof=1); rows are re-centred first to keep the sum-of-squares stable."""
+    counts = (~np.isnan(x)).sum(axis=1, keepdims=True)
+    center = np.nansum(x, axis=1, keepdims=True) / np.maximum(counts, 1)
+    xc = x - center
+    s1 = _rolling_sum(xc, window)
+    s2 = _rolling_sum(xc * xc, window)
+    mean = s1 / window
+    var = np.clip((s2 - s1 * mean) / (window - 1), 0.0, None)
+    return mean + center, np.sqrt(var)
+
+
+def _ema(x: np.ndarray, span: int) -> np.ndarray:
+    """EMA with adjust=False along axis 1, seeded at each row's first valid value.
+
+    Runs pandas' compiled ewm column-wise over the transposed matrix instead of a Python loop over bars.
+    """
+    if x.size == 0:
+        return np.full(x.shape, np.nan)
+    return pd.DataFrame(x.T).ewm(span=span, adjust=False).mean().to_numpy().T
+
+
+def _rsi(closes: np.ndarray, window: int) -> np.ndarray:
+    """RSI along axis 1 using simple rolling means of gains and losses."""
+    delta = np.full(closes.shape, np.nan)
+    delta[:, 1:] = np.diff(closes, axis=1)
+    avg_gain = _rolling_sum(np.where(np.isnan(delta), np.nan, np.clip(delta, 0, None)), window) / window
+    avg_loss = _rolling_sum(np.where(np.isnan(delta), np.nan, np.clip(-delta, 0, None)), window) / window
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 100.0 - 100.0 / (1.0 + avg_gain / avg_loss)
+
+
+def _indicator_arrays(closes: np.ndarray) -> Dict[str, np.ndarray]:
+    """Compute every indicator series for a symbols x bars close matrix in one pass."""
+    closes = np.atleast_2d(np.asarray(closes, dtype=float))
+    sma20, std20 = _rolling_mean_std(closes, 20)
+    sma50 = _rolling_sum(closes, 50) / 50.0
+    rsi = _rsi(closes, 14)
+    # MACD (12,26,9)
+    macd_line = _ema(closes, 12) - _ema(closes, 26)
+    signal = _ema(macd_line, 9)
+    return {
+        "sma20": sma20,
+        "sma50": sma50,
+        "rsi14": rsi,
+        "macd": macd_line,
+        "macd_signal": signal,
+        "macd_hist": macd_line - signal,
+        "bb_upper": sma20 + 2 * std20,
+        "bb_middle": sma20,
+        "bb_lower": sma20 - 2 * std20,
+    }
+
+
+def _empty_indicators() -> Dict[str, Any]:
+    return {
         "sma20": None,
         "sma50": None,
         "rsi14": None,
         "macd": {"macd": None, "signal": None, "hist": None},
         "bbands": {"upper": None, "middle": None, "lower": None},
     }
+
+
+def _indicator_values(arrays: Dict[str, np.ndarray], row: int, col: int = -1) -> Dict[str, Any]:
+    """Pick one bar of one symbol out of _indicator_arrays in the nested quote payload shape."""
+    def v(key: str) -> Optional[float]:
+        arr = arrays[key]
+        if arr.shape[1] == 0:
+            return None
+        x = arr[row, col]
+        return None if np.isnan(x) else float(x)
+    return {
+        "sma20": v("sma20"),
+        "sma50": v("sma50"),
+        "rsi14": v("rsi14"),
+        "macd": {"macd": v("macd"), "signal": v("macd_signal"), "hist": v("macd_hist")},
+        "bbands": {"upper": v("bb_upper"), "middle": v("bb_middle"), "lower": v("bb_lower")},
+    }
+
+
+def _compute_indicators_many(closes: Dict[str, pd.Series]) -> Dict[str, Dict[str, Any]]:
+    """Latest indicator values for many symbols from a single vectorized computation."""
+    syms = list(closes.keys())
+    if not syms:
+        return {}
     try:
-        if close is None or close.empty:
-            return indicators
-        # SMA
-        sma20 = close.rolling(20).mean()
-        sma50 = close.rolling(50).mean()
-        indicators["sma20"] = float(sma20.iloc[-1]) if len(sma20) >= 20 and not pd.isna(sma20.iloc[-1]) else None
-        indicators["sma50"] = float(sma50.iloc[-1]) if len(sma50) >= 50 and not pd.isna(sma50.iloc[-1]) else None
-
-        # RSI14 (simple rolling version)
-        delta = close.diff()
-        gain = delta.clip(lower=0)
-        loss = (-delta).clip(lower=0)
-        avg_gain = gain.rolling(14).mean()
-        avg_loss = loss.rolling(14).mean()
-        if len(avg_gain) >= 14 and len(avg_loss) >= 14:
-            ag = avg_gain.iloc[-1]
-            al = avg_loss.iloc[-1]
-            if not pd.isna(ag) and not pd.isna(al) and al != 0:
-                rs = ag / al
-                rsi = 100 - 100 / (1 + rs)
-                indicators["rsi14"] = float(rsi)
-
-        # MACD (12,26,9)
-        ema12 = close.ewm(span=12, adjust=False).mean()
-        ema26 = close.ewm(span=26, adjust=False).mean()
-        macd_line = ema12 - ema26
-        signal = macd_line.ewm(span=9, adjust=False).mean()
-        hist = macd_line - signal
-        indicators["macd"]["macd"] = float(macd_line.iloc[-1]) if not pd.isna(macd_line.iloc[-1]) else None
-        indicators["macd"]["signal"] = float(signal.iloc[-1]) if not pd.isna(signal.iloc[-1]) else None
-        indicators["macd"]["hist"] = float(hist.iloc[-1]) if not pd.isna(hist.iloc[-1]) else None
-
-        # Bollinger Bands (20, 2)
-        if len(sma20) >= 20:
-            std20 = close.rolling(20).std()
-            middle = sma20.iloc[-1]
-            stdv = std20.iloc[-1]
-            if not pd.isna(middle) and not pd.isna(stdv):
-                indicators["bbands"]["middle"] = float(middle)
-                indicators["bbands"]["upper"] = float(middle + 2 * stdv)
-                indicators["bbands"]["lower"] = float(middle - 2 * stdv)
+        arrays = _indicator_arrays(_close_matrix([closes[s].dropna().to_numpy() for s in syms]))
+        return {s: _indicator_values(arrays, i) for i, s in enumerate(syms)}
     except Exception as e:
         print(f"Indicator calc error: {e}")
-    return indicators
+        return {}
+
+
+class IndicatorState:
+    """Per-symbol running indicator state that advances by one bar in O(1).
+
+    Mirrors _indicator_arrays: ring buffers with running sums / sum of squares
+    for SMA20/50 and Bollinger, running gain/loss sums for RSI14, and EMA
+    states for MACD. The last bar can be rewritten in place, which is what an
+    intraday quote refresh does to the current daily bar.
+    """
+
+    RESUM_EVERY = 500  # 定期从缓冲区重新求和，抑制浮点累积误差
+
+    def __init__(self, closes: Any):
+        self._lock = threading.Lock()
+        values = [float(c) for c in closes if c == c]
+        self.anchor = values[0] if values else 0.0
+        self.closes: deque = deque(maxlen=50)
+        self.deltas: deque = deque(maxlen=14)
+        self.sum20 = self.sumsq20 = self.sum50 = 0.0
+        self.gain14 = self.loss14 = 0.0
+        # (ema12, ema26, signal) 当前值与上一根 bar 之后的值
+        self.ema: Optional[Tuple[float, float, float]] = None
+        self.ema_prev: Optional[Tuple[float, float, float]] = None
+        self.updates = 0
+        for v in values:
+            self._push(v)
+
+    @staticmethod
+    def _ema_step(prev: Optional[Tuple[float, float, float]], x: float) -> Tuple[float, float, float]:
+        if prev is None:
+            return (x, x, 0.0)
+        e12 = x * (2 / 13) + prev[0] * (11 / 13)
+        e26 = x * (2 / 27) + prev[1] * (25 / 27)
+        sig = (e12 - e26) * 0.2 + prev[2] * 0.8
+        return (e12, e26, sig)
+
+    def _push(self, x: float) -> None:
+        if self.closes:
+            d = x - self.closes[-1]
+            if len(self.deltas) == 14:
+                old = self.deltas[0]
+                self.gain14 -= max(old, 0.0)
+                self.loss14 -= max(-old, 0.0)
+            self.deltas.append(d)
+            self.gain14 += max(d, 0.0)
+            self.loss14 += max(-d, 0.0)
+        n = len(self.closes)
+        if n >= 20:
+            old = self.closes[-20] - self.anchor
+            self.sum20 -= old
+            self.sumsq20 -= old * old
+        if n == 50:
+            self.sum50 -= self.closes[0] - self.anchor
+        self.closes.append(x)
+        xc = x - self.anchor
+        self.sum20 += xc
+        self.sumsq20 += xc * xc
+        self.sum50 += xc
+        self.ema_prev = self.ema
+        self.ema = self._ema_step(self.ema_prev, x)
+        self._tick()
+
+    def _replace_last(self, x: float) -> None:
+        old = self.closes[-1]
+        if len(self.closes) >= 2:
+            old_d = self.deltas[-1]
+            d = x - self.closes[-2]
+            self.deltas[-1] = d
+            self.gain14 += max(d, 0.0) - max(old_d, 0.0)
+            self.loss14 += max(-d, 0.0) - max(-old_d, 0.0)
+        self.closes[-1] = x
+        oc, xc = old - self.anchor, x - self.anchor
+        self.sum20 += xc - oc
+        self.sumsq20 += xc * xc - oc * oc
+        self.sum50 += xc - oc
+        self.ema = self._ema_step(self.ema_prev, x)
+        self._tick()
+
+    def _tick(self) -> None:
+        self.updates += 1
+        if self.updates % self.RESUM_EVERY:
+            return
+        tail20 = [c - self.anchor for c in list(self.closes)[-20:]]
+        self.sum20 = sum(tail20)
+        self.sumsq20 = sum(c * c for c in tail20)
+        self.sum50 = sum(c - self.anchor for c in self.closes)
+        self.gain14 = sum(max(d, 0.0) for d in self.deltas)
+        self.loss14 = sum(max(-d, 0.0) for d in self.deltas)
+
+    def push(self, close: float) -> None:
+        with self._lock:
+            self._push(float(close))
+
+    def replace_last(self, close: float) -> None:
+        with self._lock:
+            if self.closes:
+                self._replace_last(float(close))
+            else:
+                self._push(float(close))
+
+    def observe(self, price: float, prev_close: Optional[float]) -> bool:
+        """Fold a live quote into the state; False when it cannot be reconciled and a resync is needed.
+
+        If the quote's previous close matches our second-to-last bar the price
+        belongs to the current bar; if it matches our last bar a new session
+        has started.
+        """
+        if prev_close is None:
+            return False
+        with self._lock:
+            if len(self.closes) < 2:
+                return False
+            tol = max(abs(float(prev_close)) * 1e-6, 1e-4)
+            if abs(self.closes[-2] - prev_close) <= tol:
+                self._replace_last(float(price))
+                return True
+            if abs(self.closes[-1] - prev_close) <= tol:
+                self._push(float(price))
+                return True
+            return False
+
+    def values(self) -> Dict[str, Any]:
+        with self._lock:
+            out = _empty_indicators()
+            n = len(self.closes)
+            if n >= 20:
+                mean = self.sum20 / 20
+                var = max((self.sumsq20 - self.sum20 * mean) / 19, 0.0)
+                std = var ** 0.5
+                middle = mean + self.anchor
+                out["sma20"] = middle
+                out["bbands"] = {"upper": middle + 2 * std, "middle": middle, "lower": middle - 2 * std}
+            if n >= 50:
+                out["sma50"] = self.sum50 / 50 + self.anchor
+            if len(self.deltas) >= 14:
+                ag, al = self.gain14 / 14, self.loss14 / 14
+                if al > 0:
+                    out["rsi14"] = 100 - 100 / (1 + ag / al)
+                elif ag > 0:
+                    out["rsi14"] = 100.0
+            if self.ema is not None:
+                macd = self.ema[0] - self.ema[1]
+                out["macd"] = {"macd": macd, "signal": self.ema[2], "hist": macd - self.ema[2]}
+            return out
+
+
+# 指标状态与历史数据一起保留；过期后从完整历史重新同步
+INDICATOR_STATE_TTL = float(os.environ.get("INDICATOR_STATE_TTL", 6 * 3600))
+_indicator_states = TTLCache(INDICATOR_STATE_TTL, QUOTE_CACHE_SIZE, name="indicator_states")
+
+
+def _compute_indicators(close: pd.Series) -> Dict[str, Any]:
+    if close is None or close.empty:
+        return _empty_indicators()
+    return _compute_indicators_many({"close": close}).get("close") or _empty_indicators()
 
 
 def _get_price_for_symbol(symbol: str) -> Dict[str, Any]:
-    symbol = symbol.upper().strip()
-    info: Dict[str, Any] = {
+    return _get_prices_for_symbols([symbol])[0]
+
+
+def _is_daily(interval: str) -> bool:
+    """Daily or longer bars, keyed by exchange-local calendar date rather than by instant."""
+    return interval.endswith(("d", "wk", "mo"))
+
+
+def _download_histories(symbols: List[str], period: str = "6mo", interval: str = "1d",
+                        start: Optional[str] = None) -> Dict[str, pd.DataFrame]:
+    """Fetch OHLCV for many symbols with one bulk yf.download call, split per symbol.
+
+    When ``start`` is given it replaces ``period`` (used for incremental tail backfill).
+    """
+    syms = list(dict.fromkeys(s.upper().strip() for s in symbols if s and s.strip()))
+    out: Dict[str, pd.DataFrame] = {}
+    if not syms:
+        return out
+    span = {"start": start} if start else {"period": period}
+    try:
+        # 日线及以上保留各交易所本地日期（ignore_tz=True）；否则批量下载会统一换算到多数代码的时区，
+        # 亚洲/欧洲市场的日线会落到前一个日历日
+        df = yf.download(syms, interval=interval, group_by="ticker",
+                         auto_adjust=True, actions=False, threads=True, progress=False,
+                         ignore_tz=_is_daily(interval), timeout=QUOTE_FETCH_TIMEOUT, **span)
+    except Exception as e:
+        print(f"Bulk download error for {syms}: {e}")
+        return out
+    if df is None or df.empty:
+        return out
+    if isinstance(df.columns, pd.MultiIndex):
+        available = set(df.columns.get_level_values(0))
+        for sym in syms:
+            if sym not in available:
+                continue
+            sub = df[sym].dropna(how="all")
+            if not sub.empty:
+                out[sym] = sub
+    elif len(syms) == 1:
+        out[syms[0]] = df.dropna(how="all")
+    return out
+
+
+# ----------------------
+# 本地 K 线存储（按 symbol/interval 持久化，仅向上游补拉缺失的尾部）
+# ----------------------
+BAR_STORE_DIR = os.environ.get("BAR_STORE_DIR", os.path.join(APP_DIR, "data", "bars"))
+BAR_STORE_TAIL_TTL = float(os.environ.get("BAR_STORE_TAIL_TTL", 60))
+BAR_COLUMNS = ("Open", "High", "Low", "Close", "Volume")
+_PERIOD_DAYS = {"1mo": 31, "3mo": 92, "6mo": 183, "1y": 366, "2y": 731, "5y": 1827, "10y": 3653}
+_SESSION_PERIODS = {"1d": 1, "5d": 5, "7d": 7}
+
+
+def _period_start_ms(period: str, now_ms: int) -> Optional[int]:
+    """Earliest timestamp a period must cover; None for periods the store does not understand."""
+    day = 86_400_000
+    if period == "max":
+        return 0
+    if period == "ytd":
+        return int(pd.Timestamp(year=pd.Timestamp.now("UTC").year, month=1, day=1, tz="UTC").timestamp() * 1000)
+    if period in _PERIOD_DAYS:
+        return now_ms - _PERIOD_DAYS[period] * day
+    if period in _SESSION_PERIODS:
+        # N 个交易日：多留几天跨过周末与假期
+        return now_ms - (_SESSION_PERIODS[period] * 7 // 5 + 4) * day
+    return None
+
+
+class BarStore:
+    """Columnar OHLCV store: one .npz file per (symbol, interval) plus an in-memory LRU.
+
+    Each file keeps int64 ms timestamps and float OHLCV columns together with
+    ``covered_from`` (earliest timestamp ever requested from upstream) and
+    ``fetched_at``. A request is served from disk when the stored range covers
+    its period; otherwise only the missing head or the stale tail is fetched.
+    """
+
+    def __init__(self, root: str, tail_ttl: float = 60.0, memory_size: int = 256):
+        self.root = root
+        self.tail_ttl = tail_ttl
+        self._memory = TTLCache(float("inf"), memory_size, name="bar_store")
+        self._locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._revalidating: set = set()
+        self._revalidator = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bar-revalidate")
+
+    def _path(self, symbol: str, interval: str) -> str:
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in symbol)
+        return os.path.join(self.root, interval, f"{safe}.npz")
+
+    def _lock(self, symbol: str, interval: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault((symbol, interval), threading.Lock())
+
+    def _load(self, symbol: str, interval: str) -> Optional[Dict[str, Any]]:
+        entry = self._memory.get((symbol, interval))
+        if entry is not None:
+            return entry
+        path = self._path(symbol, interval)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as z:
+                meta = json.loads(str(z["meta"]))
+                if meta.get("tz") and _is_daily(interval):
+                    # 旧格式：日线按批量时区存储，日期可能错位，整段重新拉取
+                    return None
+                ts = z["ts"]
+                idx = pd.to_datetime(ts, unit="ms", utc=True)
+                if meta.get("tz"):
+                    idx = idx.tz_convert(meta["tz"])
+                frame = pd.DataFrame({c: z[c] for c in BAR_COLUMNS}, index=idx)
+        except Exception as e:
+            print(f"Bar store read error for {symbol}/{interval}: {e}")
+            return None
+        entry = {"frame": frame, "ts": ts, "covered_from": meta["covered_from"], "fetched_at": meta["fetched_at"]}
+        self._memory.set((symbol, interval), entry)
+        return entry
+
+    def _save(self, symbol: str, interval: str, entry: Dict[str, Any]) -> None:
+        frame = entry["frame"]
+        tz = getattr(frame.index, "tz", None)
+        meta = {"covered_from": entry["covered_from"], "fetched_at": entry["fetched_at"], "tz": str(tz) if tz else None}
+        path = self._path(symbol, interval)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".tmp.npz"
+            np.savez(tmp, ts=entry["ts"], meta=np.array(json.dumps(meta)),
+                     **{c: frame[c].to_numpy(dtype=float) for c in BAR_COLUMNS})
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"Bar store write error for {symbol}/{interval}: {e}")
+        self._memory.set((symbol, interval), entry)
+
+    def _merge(self, symbol: str, interval: str, entry: Optional[Dict[str, Any]], fresh: Optional[pd.DataFrame],
+               covered_from: Optional[int], now_ms: int) -> Optional[Dict[str, Any]]:
+        if fresh is not None and not fresh.empty:
+            fresh = fresh[[c for c in BAR_COLUMNS if c in fresh]].dropna(subset=["Close"])
+        received = fresh is not None and not fresh.empty
+        if not received:
+            if entry is None:
+                return None
+            entry = {**entry, "fetched_at": now_ms}
+        else:
+            fresh_ts = _index_ms(fresh.index)
+            if entry is not None:
+                # 重叠部分以新数据为准（最后一根 bar 可能仍在形成中）
+                keep = entry["ts"] < fresh_ts[0]
+                old = entry["frame"][keep]
+                if old.index.tz is not None and fresh.index.tz is not None:
+                    fresh = fresh.tz_convert(old.index.tz)
+                frame = pd.concat([old, fresh])
+                ts = np.concatenate([entry["ts"][keep], fresh_ts])
+                prev_cover = entry["covered_from"]
+            else:
+                frame, ts, prev_cover = fresh, fresh_ts, None
+            order = np.argsort(ts, kind="stable")
+            frame, ts = frame.iloc[order], ts[order]
+            entry = {"frame": frame, "ts": ts, "covered_from": prev_cover, "fetched_at": now_ms}
+        # 只有真正拿到该代码的新数据时才扩展覆盖范围；抓取失败不能把缺口记成"已覆盖"
+        if covered_from is not None and received:
+            prev = entry["covered_from"]
+            entry["covered_from"] = covered_from if prev is None else min(prev, covered_from)
+        if entry["covered_from"] is None:
+            entry["covered_from"] = int(entry["ts"][0]) if len(entry["ts"]) else now_ms
+        self._save(symbol, interval, entry)
+        return entry
+
+    @staticmethod
+    def _slice(entry: Dict[str, Any], period: str, start_ms: int) -> pd.DataFrame:
+        frame = entry["frame"]
+        if period in _SESSION_PERIODS:
+            days = frame.index.normalize()
+            sessions = days.unique()
+            if len(sessions) == 0:
+                return frame
+            return frame[days >= sessions[-min(len(sessions), _SESSION_PERIODS[period])]]
+        return frame[entry["ts"] >= start_ms]
+
+    def _revalidate(self, symbols: List[str], period: str, interval: str) -> None:
+        """Refresh stale tails in the background, at most one pending refresh per (symbol, interval)."""
+        with self._locks_guard:
+            todo = [s for s in symbols if (s, interval) not in self._revalidating]
+            self._revalidating.update((s, interval) for s in todo)
+        if not todo:
+            return
+
+        def run() -> None:
+            try:
+                self.history_many(todo, period, interval)
+            except Exception as e:
+                print(f"Bar store revalidate error: {e}")
+            finally:
+                with self._locks_guard:
+                    self._revalidating.difference_update((s, interval) for s in todo)
+
+        self._revalidator.submit(run)
+
+    def history_many(self, symbols: List[str], period: str = "6mo", interval: str = "1d",
+                     stale_ok: bool = False) -> Dict[str, pd.DataFrame]:
+        """OHLCV per symbol for ``period``/``interval``, touching upstream only for missing ranges.
+
+        With ``stale_ok`` a stored range whose tail is older than ``tail_ttl`` is
+        returned as is and its tail is refreshed in the background.
+        """
+        syms = list(dict.fromkeys(s.upper().strip() for s in symbols if s and s.strip()))
+        now_ms = int(time.time() * 1000)
+        start_ms = _period_start_ms(period, now_ms)
+        if start_ms is None:
+            return _download_histories(syms, period=period, interval=interval)
+        out: Dict[str, pd.DataFrame] = {}
+        full: List[str] = []
+        tails: Dict[str, List[str]] = {}
+        stale: List[str] = []
+        for sym in syms:
+            entry = self._load(sym, interval)
+            if entry is None or entry["covered_from"] > start_ms:
+                full.append(sym)
+            elif now_ms - entry["fetched_at"] > self.tail_ttl * 1000 and stale_ok:
+                out[sym] = self._slice(entry, period, start_ms)
+                stale.append(sym)
+            elif now_ms - entry["fetched_at"] > self.tail_ttl * 1000:
+                last_day = entry["frame"].index[-1].strftime("%Y-%m-%d") if len(entry["ts"]) else None
+                tails.setdefault(last_day, []).append(sym)
+            else:
+                out[sym] = self._slice(entry, period, start_ms)
+        fetches = [(full, {"period": period}, start_ms)] if full else []
+        fetches += [(group, {"start": day} if day else {"period": period}, None if day else start_ms)
+                    for day, group in tails.items()]
+        for group, span, covered_from in fetches:
+            fresh = _download_histories(group, interval=interval, **span)
+            for sym in group:
+                with self._lock(sym, interval):
+                    entry = self._merge(sym, interval, self._load(sym, interval), fresh.get(sym), covered_from, now_ms)
+                if entry is not None:
+                    out[sym] = self._slice(entry, period, start_ms)
+        if stale:
+            self._revalidate(stale, period, interval)
+        return out
+
+    def history(self, symbol: str, period: str = "6mo", interval: str = "1d") -> pd.DataFrame:
+        sym = symbol.upper().strip()
+        return self.history_many([sym], period, interval).get(sym, pd.DataFrame())
+
+
+_bar_store = BarStore(BAR_STORE_DIR, BAR_STORE_TAIL_TTL)
+
+
+def _get_prices_for_symbols(symbols: List[str]) -> List[Dict[str, Any]]:
+    """Batched variant of _get_price_for_symbol: cache misses share one bulk history download.
+
+    Recently expired quotes are served immediately (flagged ``stale``) while the
+    refresher revalidates them in the background.
+    """
+    syms = [s.upper().strip() for s in symbols if s and s.strip()]
+    unique = list(dict.fromkeys(syms))
+    _quote_refresher.touch(unique)
+    quotes: Dict[str, Dict[str, Any]] = {}
+    missing = []
+    stale = []
+    for sym in unique:
+        q = _quote_cache.get(sym)
+        if q is not None:
+            quotes[sym] = q
+            continue
+        q = _quote_cache.get_stale(sym)
+        if q is not None:
+            quotes[sym] = {**q, "stale": True}
+            stale.append(sym)
+        else:
+            missing.append(sym)
+    if stale:
+        _quote_refresher.revalidate(stale)
+    if missing:
+        quotes.update(_fetch_quotes(missing))
+        _quote_refresher.mark_refreshed([s for s in missing if not quotes[s].get("error")])
+    return [dict(quotes[s]) for s in syms]
+
+
+def _fetch_quotes(symbols: List[str], force: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Fetch quotes from upstream and store successful ones in the quote cache.
+
+    Without ``force`` concurrent callers for the same symbol share one fetch and a
+    quote cached meanwhile is reused; ``force`` always refetches (background refresh).
+    """
+    # 已有指标状态的代码只需实时价格，无需重新下载整段历史
+    histories = _bar_store.history_many([s for s in symbols if _indicator_states.get(s) is None], "6mo", "1d")
+    indicators = _compute_indicators_many({sym: h["Close"] for sym, h in histories.items() if "Close" in h})
+
+    def load(sym: str) -> Dict[str, Any]:
+        return _fetch_price_for_symbol(sym, histories.get(sym), indicators.get(sym))
+
+    def refresh(sym: str) -> Dict[str, Any]:
+        q = load(sym)
+        if not q.get("error"):
+            _quote_cache.set(sym, q)
+        return q
+
+    futures = {
+        sym: (_fetch_executor.submit(refresh, sym) if force else
+              _fetch_executor.submit(_quote_cache.get_or_set, sym, lambda sym=sym: load(sym), lambda q: not q.get("error")))
+        for sym in symbols
+    }
+    # 超时未完成的任务继续在后台运行并写入缓存，下次请求即可命中
+    wait(futures.values(), timeout=QUOTE_FETCH_TIMEOUT)
+    quotes: Dict[str, Dict[str, Any]] = {}
+    for sym, fut in futures.items():
+        if fut.done() and fut.exception() is None:
+            quotes[sym] = fut.result()
+        else:
+            q = _empty_quote(sym)
+            q["error"] = "timeout" if not fut.done() else str(fut.exception())
+            quotes[sym] = q
+    return quotes
+
+
+# ----------------------
+# 后台行情刷新：按关注度分层定时刷新，请求处理只读预计算快照
+# ----------------------
+QUOTE_REFRESH_TIERS = {
+    "hot": float(os.environ.get("QUOTE_REFRESH_HOT", 15)),
+    "warm": float(os.environ.get("QUOTE_REFRESH_WARM", 60)),
+    "cold": float(os.environ.get("QUOTE_REFRESH_COLD", 300)),
+}
+QUOTE_RECENT_TTL = float(os.environ.get("QUOTE_RECENT_TTL", 1800))
+# 最近访问登记表上限：任意输入的代码不会无限扩大热层轮询
+QUOTE_RECENT_MAX = int(os.environ.get("QUOTE_RECENT_MAX", 200))
+QUOTE_REFRESH_TICK = float(os.environ.get("QUOTE_REFRESH_TICK", 5))
+QUOTE_REFRESH_BATCH = int(os.environ.get("QUOTE_REFRESH_BATCH", 50))
+
+
+class QuoteRefresher:
+    """Symbol-interest registry plus a daemon thread that keeps interesting quotes warm.
+
+    Tiers: ``hot`` = watchlist, HOT_LIST, streamed and recently requested
+    symbols; ``warm`` = index symbols; ``cold`` = index constituents. Each tier
+    is refreshed on its own cadence so readers normally hit a fresh cache entry.
+    """
+
+    def __init__(self, tiers: Dict[str, float], recent_ttl: float, tick: float, recent_max: int = 200):
+        self.tiers = tiers
+        self.recent_ttl = recent_ttl
+        self.recent_max = recent_max
+        self.tick = tick
+        # LRU：超过 recent_max 时淘汰最久未访问的代码
+        self._recent: "OrderedDict[str, float]" = OrderedDict()
+        self._refreshed: Dict[str, float] = {}
+        self._pending: set = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._revalidator = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quote-revalidate")
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="quote-refresher", daemon=True)
+            self._thread.start()
+
+    def touch(self, symbols: List[str]) -> None:
+        now = time.time()
+        with self._lock:
+            for sym in symbols:
+                self._recent[sym] = now
+                self._recent.move_to_end(sym)
+            while len(self._recent) > self.recent_max:
+                self._recent.popitem(last=False)
+        self.start()
+
+    def interest(self) -> Dict[str, str]:
+        """Current tier for every tracked symbol (the most urgent tier wins)."""
+        now = time.time()
+        tiers: Dict[str, str] = {}
+        for idx in INDICES:
+            for sym in idx.get("constituents") or []:
+                tiers[sym] = "cold"
+        for idx in INDICES:
+            if idx.get("symbol"):
+                tiers[idx["symbol"]] = "warm"
+        with self._lock:
+            while self._recent and now - next(iter(self._recent.values())) > self.recent_ttl:
+                self._recent.popitem(last=False)
+            recent = list(self._recent)
+        for sym in list(_load_watchlist()) + HOT_LIST + _quote_hub.symbols() + recent:
+            tiers[sym] = "hot"
+        return tiers
+
+    def due(self) -> List[str]:
+        now = time.time()
+        tiers = self.interest()
+        with self._lock:
+            return [s for s, tier in tiers.items()
+                    if s not in self._pending and now - self._refreshed.get(s, 0.0) >= self.tiers[tier]]
+
+    def mark_refreshed(self, symbols: List[str]) -> None:
+        now = time.time()
+        with self._lock:
+            for sym in symbols:
+                self._refreshed[sym] = now
+
+    def refresh(self, symbols: List[str]) -> None:
+        with self._lock:
+            symbols = [s for s in symbols if s not in self._pending]
+            self._pending.update(symbols)
+        try:
+            for i in range(0, len(symbols), QUOTE_REFRESH_BATCH):
+                chunk = symbols[i:i + QUOTE_REFRESH_BATCH]
+                _fetch_quotes(chunk, force=True)
+                self.mark_refreshed(chunk)
+        except Exception as e:
+            print(f"Quote refresh error: {e}")
+        finally:
+            with self._lock:
+                self._pending.difference_update(symbols)
+
+    def revalidate(self, symbols: List[str]) -> None:
+        with self._lock:
+            todo = [s for s in symbols if s not in self._pending]
+        if todo:
+            self._revalidator.submit(self.refresh, todo)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                syms = self.due()
+                if syms:
+                    self.refresh(syms)
+            except Exception as e:
+                print(f"Quote refresher error: {e}")
+            time.sleep(self.tick)
+
+
+_quote_refresher = QuoteRefresher(QUOTE_REFRESH_TIERS, QUOTE_RECENT_TTL, QUOTE_REFRESH_TICK, QUOTE_RECENT_MAX)
+
+
+def _empty_quote(symbol: str) -> Dict[str, Any]:
+    return {
         "symbol": symbol,
         "price": None,
         "currency": None,
@@ -145,8 +964,13 @@ def _get_price_for_symbol(symbol: str) -> Dict[str, Any]:
         "market_cap": None,
         "year_high": None,
         "year_low": None,
-        "indicators": {"sma20": None, "sma50": None, "rsi14": None, "macd": {"macd": None, "signal": None, "hist": None}, "bbands": {"upper": None, "middle": None, "lower": None}},
+        "indicators": _empty_indicators(),
     }
+
+
+def _fetch_price_for_symbol(symbol: str, history: Optional[pd.DataFrame] = None,
+                            indicators: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    info = _empty_quote(symbol)
     try:
         t = yf.Ticker(symbol)
         price = None
@@ -184,34 +1008,42 @@ def _get_price_for_symbol(symbol: str) -> Dict[str, Any]:
                 pass
 
         # Fallback to last close if still None
-        hist: pd.DataFrame = pd.DataFrame()
+        hist: pd.DataFrame = history if history is not None else pd.DataFrame()
         if price is None:
             try:
-                hist = t.history(period="1d")
+                if hist.empty:
+                    hist = t.history(period="1d")
                 if not hist.empty:
-                    price = float(hist["Close"].iloc[-1])
+                    price = float(hist["Close"].dropna().iloc[-1])
             except Exception:
                 pass
 
-        # Compute change and indicators using broader history
-        try:
-            if hist.empty:
-                hist = t.history(period="6mo", interval="1d")
-            if not hist.empty:
-                close = hist["Close"].dropna()
-                # prev_close fallback
-                if info["prev_close"] is None and len(close) >= 2:
-                    info["prev_close"] = float(close.iloc[-2])
-                # change
-                if price is not None and info["prev_close"] is not None:
-                    ch = float(price) - float(info["prev_close"])
-                    info["change"] = ch
-                    if info["prev_close"] != 0:
-                        info["change_percent"] = ch / float(info["prev_close"]) * 100.0
-                # indicators
-                info["indicators"] = _compute_indicators(close)
-        except Exception as e:
-            print(f"History fetch/compute error for {symbol}: {e}")
+        # Compute change and indicators: advance the cached state by the live price when
+        # possible, otherwise rebuild from broader history and reseed the state
+        state = _indicator_states.get(symbol) if history is None else None
+        if state is not None and price is not None and state.observe(float(price), info["prev_close"]):
+            info["indicators"] = state.values()
+        else:
+            try:
+                if hist.empty:
+                    hist = _bar_store.history(symbol, "6mo", "1d")
+                if not hist.empty:
+                    close = hist["Close"].dropna()
+                    # prev_close fallback
+                    if info["prev_close"] is None and len(close) >= 2:
+                        info["prev_close"] = float(close.iloc[-2])
+                    # indicators
+                    info["indicators"] = indicators or _compute_indicators(close)
+                    if len(close) >= 2:
+                        _indicator_states.set(symbol, IndicatorState(close.to_numpy()))
+            except Exception as e:
+                print(f"History fetch/compute error for {symbol}: {e}")
+        # change
+        if price is not None and info["prev_close"] is not None:
+            ch = float(price) - float(info["prev_close"])
+            info["change"] = ch
+            if info["prev_close"] != 0:
+                info["change_percent"] = ch / float(info["prev_close"]) * 100.0
 
         info["price"] = float(price) if price is not None else None
         info["currency"] = currency
@@ -226,6 +1058,13 @@ def health():
     return jsonify({"status": "ok"})
 
 
+@app.get("/api/cache/stats")
+def cache_stats():
+    return jsonify({"caches": [_quote_cache.stats(), _indicator_states.stats(), _bar_store._memory.stats(),
+                               _company_cache._memory.stats(), _ai_cache.stats()],
+                    "upstream": {"llm": _llm_client.stats()}})
+
+
 @app.get("/api/watchlist")
 def get_watchlist():
     return jsonify({"symbols": _load_watchlist()})
@@ -260,27 +1099,150 @@ def get_prices():
         symbols = [s.strip().upper() for s in symbols_param.split(",") if s.strip()]
     else:
         symbols = _load_watchlist()
-    results = [_get_price_for_symbol(s) for s in symbols]
+    results = _get_prices_for_symbols(symbols)
     return jsonify({"results": results})
 
 
+# ----------------------
+# 行情推送（SSE）：单个后台刷新循环，只向订阅者推送发生变化的报价
+# ----------------------
+QUOTE_STREAM_INTERVAL = float(os.environ.get("QUOTE_STREAM_INTERVAL", 15))
+QUOTE_STREAM_KEEPALIVE = float(os.environ.get("QUOTE_STREAM_KEEPALIVE", 20))
+
+
+# 只有价格与指标变化才推送；ts、stale 等缓存元数据变化不算
+QUOTE_STREAM_FIELDS = ("price", "change", "change_percent", "prev_close", "indicators")
+
+
+def _quote_changed(old: Optional[Dict[str, Any]], new: Dict[str, Any]) -> bool:
+    if old is None:
+        return True
+    return any(old.get(k) != new.get(k) for k in QUOTE_STREAM_FIELDS)
+
+
+class QuoteHub:
+    """Fan-out of quote diffs to SSE subscribers.
+
+    One daemon thread refreshes the union of all subscribed symbols every
+    ``interval`` seconds, so upstream load scales with distinct symbols rather
+    than with the number of open tabs.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._subs: Dict[int, Tuple[frozenset, "queue.Queue[List[Dict[str, Any]]]"]] = {}
+        self._last: Dict[str, Dict[str, Any]] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, symbols: List[str]) -> Tuple[int, "queue.Queue[List[Dict[str, Any]]]"]:
+        q: "queue.Queue[List[Dict[str, Any]]]" = queue.Queue(maxsize=16)
+        with self._lock:
+            sub_id = next(self._ids)
+            self._subs[sub_id] = (frozenset(symbols), q)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="quote-hub", daemon=True)
+                self._thread.start()
+        return sub_id, q
+
+    def unsubscribe(self, sub_id: int) -> None:
+        with self._lock:
+            self._subs.pop(sub_id, None)
+
+    def symbols(self) -> List[str]:
+        with self._lock:
+            return sorted(set().union(*(syms for syms, _ in self._subs.values())))
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            syms = self.symbols()
+            if not syms:
+                continue
+            try:
+                quotes = _get_prices_for_symbols(syms)
+            except Exception as e:
+                print(f"Quote hub refresh error: {e}")
+                continue
+            with self._lock:
+                changed = {q["symbol"]: q for q in quotes
+                           if not q.get("error") and _quote_changed(self._last.get(q["symbol"]), q)}
+                self._last.update(changed)
+                subs = list(self._subs.values())
+            if not changed:
+                continue
+            for syms_wanted, q in subs:
+                diff = [changed[s] for s in syms_wanted if s in changed]
+                if not diff:
+                    continue
+                try:
+                    q.put_nowait(diff)
+                except queue.Full:
+                    pass  # 客户端消费过慢：丢弃本轮，下一轮变化仍会推送
+
+
+_quote_hub = QuoteHub(QUOTE_STREAM_INTERVAL)
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/api/stream/prices")
+def stream_prices():
+    symbols_param = request.args.get("symbols")
+    if symbols_param:
+        symbols = [s.strip().upper() for s in symbols_param.split(",") if s.strip()]
+    else:
+        symbols = _load_watchlist()
+    symbols = list(dict.fromkeys(symbols))
+    sub_id, q = _quote_hub.subscribe(symbols)
+
+    def gen():
+        try:
+            # 首帧发送完整快照（通常直接命中行情缓存）
+            snapshot = _get_prices_for_symbols(symbols)
+            yield _sse("quotes", {"results": snapshot, "snapshot": True})
+            while True:
+                try:
+                    diff = q.get(timeout=QUOTE_STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse("quotes", {"results": diff, "snapshot": False})
+        finally:
+            _quote_hub.unsubscribe(sub_id)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(gen()), mimetype="text/event-stream", headers=headers)
+
+
 @app.get("/api/hot")
 def get_hot():
-    results = [_get_price_for_symbol(s) for s in HOT_LIST]
+    results = _get_prices_for_symbols(HOT_LIST)
     return jsonify({"results": results})
 
 
 @app.get("/api/indices")
 def get_indices():
     category = request.args.get("category")
+    include = {x.strip() for x in (request.args.get("include") or "").split(",")}
+    with_constituents = "constituents" in include
     source = [i for i in INDICES if (not category or i.get("category") == category)]
+    # 指数与成分股行情合并成一次去重的批量请求（同一代码只拉取一次）
+    symbols = [idx["symbol"] for idx in source if idx.get("symbol")]
+    if with_constituents:
+        symbols += [sym for idx in source for sym in idx["constituents"]]
+    try:
+        quotes = {q["symbol"]: q for q in _get_prices_for_symbols(symbols)}
+    except Exception as e:
+        print(f"Indices quote error: {e}")
+        quotes = {}
     payload = []
     for idx in source:
-        try:
-            idx_info = _get_price_for_symbol(idx["symbol"]) if idx.get("symbol") else {}
-        except Exception:
-            idx_info = {}
-        payload.append({
+        idx_info = quotes.get(idx["symbol"], {})
+        item = {
             "symbol": idx["symbol"],
             "name": idx["name"],
             "category": idx.get("category"),
@@ -288,7 +1250,10 @@ def get_indices():
             "change_percent": idx_info.get("change_percent"),
             "indicators": idx_info.get("indicators"),
             "constituents": idx["constituents"],
-        })
+        }
+        if with_constituents:
+            item["constituent_quotes"] = [quotes.get(sym) or _empty_quote(sym) for sym in idx["constituents"]]
+        payload.append(item)
     return jsonify({"indices": payload})
 
 
@@ -301,205 +1266,306 @@ def get_index_constituents(symbol: str):
     return jsonify({"symbol": sym, "constituents": idx["constituents"]})
 
 
+def _json_array(values: Any) -> Any:
+    """Float array ready for _json_response: kept as ndarray for orjson, else NaN/inf mapped to None in one pass."""
+    arr = np.asarray(values, dtype=float)
+    if orjson is not None:
+        return np.ascontiguousarray(arr)
+    out = arr.astype(object)
+    out[~np.isfinite(arr)] = None
+    return out.tolist()
+
+
+def _json_response(payload: Any, status: int = 200) -> Response:
+    """Serialize with orjson when installed (native NumPy support, NaN -> null), falling back to jsonify."""
+    if orjson is None:
+        resp = jsonify(payload)
+        resp.status_code = status
+        return resp
+    body = orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return Response(body, status=status, mimetype="application/json")
+
+
+def _history_payload(sym: str, df: Optional[pd.DataFrame]) -> Dict[str, Any]:
+    """Columnar OHLCV + indicator payload for /api/history."""
+    if df is None or df.empty:
+        return {
+            "symbol": sym,
+            "ts": [],
+            "open": [],
+            "high": [],
+            "low": [],
+            "close": [],
+            "volume": [],
+            "indicators": {
+                "sma20": [],
+                "sma50": [],
+                "bbands": {"upper": [], "middle": [], "lower": []},
+                "rsi14": [],
+                "macd": {"macd": [], "signal": [], "hist": []},
+            }
+        }
+    df = df.dropna()
+    ts = _index_ms(df.index)
+    ind = {k: _json_array(v[0]) for k, v in _indicator_arrays(df["Close"].to_numpy(dtype=float)).items()}
+    return {
+        "symbol": sym,
+        "ts": ts if orjson is not None else ts.tolist(),
+        "open": _json_array(df["Open"]),
+        "high": _json_array(df["High"]),
+        "low": _json_array(df["Low"]),
+        "close": _json_array(df["Close"]),
+        "volume": _json_array(df["Volume"]),
+        "indicators": {
+            "sma20": ind["sma20"],
+            "sma50": ind["sma50"],
+            "bbands": {
+                "upper": ind["bb_upper"],
+                "middle": ind["bb_middle"],
+                "lower": ind["bb_lower"],
+            },
+            "rsi14": ind["rsi14"],
+            "macd": {
+                "macd": ind["macd"],
+                "signal": ind["macd_signal"],
+                "hist": ind["macd_hist"],
+            },
+        },
+    }
+
+
 @app.get("/api/history/<symbol>")
 def get_history(symbol: str):
     sym = symbol.upper().strip()
     period = request.args.get("period", "6mo")
     interval = request.args.get("interval", "1d")
     try:
-        t = yf.Ticker(sym)
-        df: pd.DataFrame = t.history(period=period, interval=interval)
-        if df is None or df.empty:
-            return jsonify({
-                "symbol": sym,
-                "ts": [],
-                "open": [],
-                "high": [],
-                "low": [],
-                "close": [],
-                "volume": [],
-                "indicators": {
-                    "sma20": [],
-                    "sma50": [],
-                    "bbands": {"upper": [], "middle": [], "lower": []},
-                    "rsi14": [],
-                    "macd": {"macd": [], "signal": [], "hist": []},
-                }
-            })
-        df = df.dropna()
-        # Ensure index is datetime
-        idx = df.index
-        ts = [int(pd.Timestamp(i).timestamp() * 1000) for i in idx]
-        close = df["Close"].astype(float)
-        sma20 = close.rolling(20).mean()
-        sma50 = close.rolling(50).mean()
-        std20 = close.rolling(20).std()
-        upper = sma20 + 2 * std20
-        lower = sma20 - 2 * std20
-        middle = sma20
-        # RSI14 series
-        delta = close.diff()
-        gain = delta.clip(lower=0)
-        loss = (-delta).clip(lower=0)
-        avg_gain = gain.rolling(14).mean()
-        avg_loss = loss.rolling(14).mean()
-        rs = avg_gain / avg_loss
-        rsi = 100 - 100 / (1 + rs)
-        # MACD series (12,26,9)
-        ema12 = close.ewm(span=12, adjust=False).mean()
-        ema26 = close.ewm(span=26, adjust=False).mean()
-        macd_line = ema12 - ema26
-        signal = macd_line.ewm(span=9, adjust=False).mean()
-        hist = macd_line - signal
-        # Convert to python floats or None
-        def to_list(series: pd.Series):
-            out = []
-            for v in series:
-                if pd.isna(v) or v is None:
-                    out.append(None)
-                else:
-                    out.append(float(v))
-            return out
-        payload = {
-            "symbol": sym,
-            "ts": ts,
-            "open": to_list(df["Open"]),
-            "high": to_list(df["High"]),
-            "low": to_list(df["Low"]),
-            "close": to_list(df["Close"]),
-            "volume": to_list(df["Volume"]),
-            "indicators": {
-                "sma20": to_list(sma20),
-                "sma50": to_list(sma50),
-                "bbands": {
-                    "upper": to_list(upper),
-                    "middle": to_list(middle),
-                    "lower": to_list(lower),
-                },
-                "rsi14": to_list(rsi),
-                "macd": {
-                    "macd": to_list(macd_line),
-                    "signal": to_list(signal),
-                    "hist": to_list(hist),
-                },
-            },
-        }
-        return jsonify(payload)
+        df = _bar_store.history(sym, period, interval)
+        return _json_response(_history_payload(sym, df))
     except Exception as e:
         return jsonify({"symbol": sym, "error": str(e)}), 500
 
-# 新增：公司信息与最新新闻接口
-@app.get("/api/company/<symbol>")
-def get_company(symbol: str):
-    sym = symbol.upper().strip()
+# ----------------------
+# 公司资料缓存（落盘，按区块分别判断新鲜度：资料按天、财报按季度）
+# ----------------------
+COMPANY_CACHE_DIR = os.environ.get("COMPANY_CACHE_DIR", os.path.join(APP_DIR, "data", "company"))
+COMPANY_PROFILE_TTL = float(os.environ.get("COMPANY_PROFILE_TTL", 86400))
+COMPANY_STATEMENTS_TTL = float(os.environ.get("COMPANY_STATEMENTS_TTL", 90 * 86400))
+
+
+class SectionCache:
+    """Disk-backed JSON document per key, with an independent TTL for each section.
+
+    A section is reloaded only when it is older than its TTL; if the reload
+    fails the previous (stale) data is served instead of nothing.
+    """
+
+    def __init__(self, root: str, ttls: Dict[str, float], memory_size: int = 512, name: str = "sections"):
+        self.root = root
+        self.ttls = ttls
+        self._memory = TTLCache(float("inf"), memory_size, name=name)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in key)
+        return os.path.join(self.root, f"{safe}.json")
+
+    def _doc(self, key: str) -> Dict[str, Any]:
+        doc = self._memory.get(key)
+        if doc is not None:
+            return doc
+        doc = {}
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                doc = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Section cache read error for {key}: {e}")
+        self._memory.set(key, doc)
+        return doc
+
+    def _write(self, key: str, doc: Dict[str, Any]) -> None:
+        path = self._path(key)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(doc, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"Section cache write error for {key}: {e}")
+
+    def peek(self, key: str, section: str) -> Optional[Any]:
+        """Cached section data regardless of age, without touching upstream."""
+        sec = self._doc(key).get(section)
+        return sec.get("data") if sec else None
+
+    def get(self, key: str, section: str, loader: Callable[[], Optional[Any]]) -> Optional[Any]:
+        """Fresh section data, calling ``loader`` when missing or expired (None from loader = failure)."""
+        with self._locks_guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            doc = self._doc(key)
+            sec = doc.get(section)
+            if sec and time.time() - sec.get("fetched_at", 0) < self.ttls[section]:
+                return sec.get("data")
+            data = loader()
+            if data is None:
+                return sec.get("data") if sec else None
+            doc = {**doc, section: {"fetched_at": time.time(), "data": data}}
+            self._memory.set(key, doc)
+            self._write(key, doc)
+            return data
+
+
+_company_cache = SectionCache(
+    COMPANY_CACHE_DIR,
+    {"profile": COMPANY_PROFILE_TTL, "statements": COMPANY_STATEMENTS_TTL},
+    name="company",
+)
+
+# 公司资料（get_info 冷启动约 1 秒/个）使用独立线程池，避免占满行情抓取池
+COMPANY_FETCH_WORKERS = int(os.environ.get("COMPANY_FETCH_WORKERS", 4))
+_company_executor = ThreadPoolExecutor(max_workers=COMPANY_FETCH_WORKERS, thread_name_prefix="company-fetch")
+
+
+def _ticker_info(t: Any) -> Dict[str, Any]:
     try:
-        t = yf.Ticker(sym)
-        data = {}
+        return t.get_info() or {}
+    except Exception:
         try:
-            data = t.get_info() or {}
+            return t.info or {}
         except Exception:
-            try:
-                data = t.info or {}
-            except Exception:
-                data = {}
-        info = {
-            "symbol": sym,
-            "name": data.get("longName") or data.get("shortName"),
-            "sector": data.get("sector"),
-            "industry": data.get("industry"),
-            "website": data.get("website"),
-            "summary": data.get("longBusinessSummary"),
-            "market_cap": data.get("marketCap"),
-            "employees": data.get("fullTimeEmployees"),
-            "country": data.get("country"),
-            "city": data.get("city"),
-        }
-        # 基本面指标（尽量使用 info 中现成字段，缺失则为 None）
-        fundamentals = {
-            "pe": data.get("trailingPE"),
-            "forward_pe": data.get("forwardPE"),
-            "ps": data.get("priceToSalesTrailing12Months"),
-            "pb": data.get("priceToBook"),
-            "peg": data.get("pegRatio"),
-            "beta": data.get("beta"),
-            "dividend_yield": data.get("dividendYield"),
-            "payout_ratio": data.get("payoutRatio"),
-            "gross_margins": data.get("grossMargins"),
-            "operating_margins": data.get("operatingMargins"),
-            "profit_margins": data.get("profitMargins"),
-            "revenue_ttm": data.get("totalRevenue"),
-            "ebitda": data.get("ebitda"),
-            "net_income_ttm": data.get("netIncomeToCommon"),
-            "roe": data.get("returnOnEquity"),
-            "roa": data.get("returnOnAssets"),
-            "total_debt": data.get("totalDebt"),
-            "debt_to_equity": data.get("debtToEquity"),
-            "free_cash_flow": data.get("freeCashflow"),
-        }
-        # 财务报表快照（取最近一期数值）
-        def last_value(df: pd.DataFrame, row_names: list[str]):
-            try:
-                if not isinstance(df, pd.DataFrame) or df.empty:
-                    return None
-                idx = df.index.astype(str).tolist()
-                # 找到可用的行名
-                target = None
-                for name in row_names:
-                    if name in df.index:
-                        target = name
+            return {}
+
+
+def _company_profile_from_info(sym: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    info = {
+        "symbol": sym,
+        "name": data.get("longName") or data.get("shortName"),
+        "sector": data.get("sector"),
+        "industry": data.get("industry"),
+        "website": data.get("website"),
+        "summary": data.get("longBusinessSummary"),
+        "market_cap": data.get("marketCap"),
+        "employees": data.get("fullTimeEmployees"),
+        "country": data.get("country"),
+        "city": data.get("city"),
+    }
+    # 基本面指标（尽量使用 info 中现成字段，缺失则为 None）
+    fundamentals = {
+        "pe": data.get("trailingPE"),
+        "forward_pe": data.get("forwardPE"),
+        "ps": data.get("priceToSalesTrailing12Months"),
+        "pb": data.get("priceToBook"),
+        "peg": data.get("pegRatio"),
+        "beta": data.get("beta"),
+        "dividend_yield": data.get("dividendYield"),
+        "payout_ratio": data.get("payoutRatio"),
+        "gross_margins": data.get("grossMargins"),
+        "operating_margins": data.get("operatingMargins"),
+        "profit_margins": data.get("profitMargins"),
+        "revenue_ttm": data.get("totalRevenue"),
+        "ebitda": data.get("ebitda"),
+        "net_income_ttm": data.get("netIncomeToCommon"),
+        "roe": data.get("returnOnEquity"),
+        "roa": data.get("returnOnAssets"),
+        "total_debt": data.get("totalDebt"),
+        "debt_to_equity": data.get("debtToEquity"),
+        "free_cash_flow": data.get("freeCashflow"),
+    }
+    return {"info": info, "fundamentals": fundamentals}
+
+
+def _load_company_profile(sym: str) -> Optional[Dict[str, Any]]:
+    data = _ticker_info(yf.Ticker(sym))
+    return _company_profile_from_info(sym, data) if data else None
+
+
+# 财务报表快照（取最近一期数值）
+def _last_statement_value(df: Any, row_names: List[str]) -> Optional[float]:
+    try:
+        if not isinstance(df, pd.DataFrame) or df.empty:
+            return None
+        idx = df.index.astype(str).tolist()
+        # 找到可用的行名
+        target = None
+        for name in row_names:
+            if name in df.index:
+                target = name
+                break
+        if not target:
+            # 尝试大小写或近似匹配
+            for name in row_names:
+                for i in idx:
+                    if i.strip().lower() == name.strip().lower():
+                        target = i
                         break
-                if not target:
-                    # 尝试大小写或近似匹配
-                    for name in row_names:
-                        for i in idx:
-                            if i.strip().lower() == name.strip().lower():
-                                target = i
-                                break
-                        if target:
-                            break
-                if not target:
-                    return None
-                series = df.loc[target]
-                series = series.dropna()
-                if series.empty:
-                    return None
-                # 列通常按最近日期在左或右，取第一个非空
-                val = series.iloc[0]
-                try:
-                    return float(val)
-                except Exception:
-                    return None
-            except Exception:
-                return None
-        try:
-            fin = t.financials
-        except Exception:
-            fin = None
+                if target:
+                    break
+        if not target:
+            return None
+        series = df.loc[target]
+        series = series.dropna()
+        if series.empty:
+            return None
+        # 列通常按最近日期在左或右，取第一个非空
+        val = series.iloc[0]
         try:
-            bs = t.balance_sheet
+            return float(val)
         except Exception:
-            bs = None
+            return None
+    except Exception:
+        return None
+
+
+def _company_statements_from_frames(fin: Any, bs: Any, cf: Any) -> Dict[str, Any]:
+    return {
+        "annual": {
+            "revenue": _last_statement_value(fin, ["Total Revenue", "totalRevenue"]),
+            "gross_profit": _last_statement_value(fin, ["Gross Profit", "grossProfit"]),
+            "operating_income": _last_statement_value(fin, ["Operating Income", "operatingIncome"]),
+            "net_income": _last_statement_value(fin, ["Net Income", "netIncome"]),
+        },
+        "balance_sheet": {
+            "assets": _last_statement_value(bs, ["Total Assets", "totalAssets"]),
+            "liabilities": _last_statement_value(bs, ["Total Liab", "Total Liabilities", "totalLiab", "totalLiabilities"]),
+            "equity": _last_statement_value(bs, ["Total Stockholder Equity", "totalStockholderEquity", "Stockholders Equity"]),
+        },
+        "cashflow": {
+            "operating_cash_flow": _last_statement_value(cf, ["Operating Cash Flow", "totalCashFromOperatingActivities", "operatingCashFlow"]),
+            "capital_expenditures": _last_statement_value(cf, ["Capital Expenditures", "capitalExpenditures"]),
+        },
+    }
+
+
+def _load_company_statements(sym: str) -> Optional[Dict[str, Any]]:
+    t = yf.Ticker(sym)
+    frames = []
+    for attr in ("financials", "balance_sheet", "cashflow"):
         try:
-            cf = t.cashflow
+            frames.append(getattr(t, attr))
         except Exception:
-            cf = None
-        financials = {
-            "annual": {
-                "revenue": last_value(fin, ["Total Revenue", "totalRevenue"]),
-                "gross_profit": last_value(fin, ["Gross Profit", "grossProfit"]),
-                "operating_income": last_value(fin, ["Operating Income", "operatingIncome"]),
-                "net_income": last_value(fin, ["Net Income", "netIncome"]),
-            },
-            "balance_sheet": {
-                "assets": last_value(bs, ["Total Assets", "totalAssets"]),
-                "liabilities": last_value(bs, ["Total Liab", "Total Liabilities", "totalLiab", "totalLiabilities"]),
-                "equity": last_value(bs, ["Total Stockholder Equity", "totalStockholderEquity", "Stockholders Equity"]),
-            },
-            "cashflow": {
-                "operating_cash_flow": last_value(cf, ["Operating Cash Flow", "totalCashFromOperatingActivities", "operatingCashFlow"]),
-                "capital_expenditures": last_value(cf, ["Capital Expenditures", "capitalExpenditures"]),
-            },
-        }
+            frames.append(None)
+    if not any(isinstance(f, pd.DataFrame) and not f.empty for f in frames):
+        return None
+    return _company_statements_from_frames(*frames)
+
+
+# 新增：公司信息与最新新闻接口
+@app.get("/api/company/<symbol>")
+def get_company(symbol: str):
+    sym = symbol.upper().strip()
+    try:
+        profile = (_company_cache.get(sym, "profile", lambda: _load_company_profile(sym))
+                   or _company_profile_from_info(sym, {}))
+        statements = (_company_cache.get(sym, "statements", lambda: _load_company_statements(sym))
+                      or _company_statements_from_frames(None, None, None))
+        info = profile["info"]
+        fundamentals = profile["fundamentals"]
+        financials = {k: dict(v) for k, v in statements.items()}
         # 计算自由现金流（如有数据，可用 operating + capex；注意 capex 通常为负数）
         ocf = financials["cashflow"].get("operating_cash_flow")
         capex = financials["cashflow"].get("capital_expenditures")
@@ -532,29 +1598,41 @@ def _portfolio_diversity_score(weights):
     score = max(0.0, min(1.0, 1.0 - hhi)) * 100.0
     return round(score, 1), hhi
 
+def _company_basic_from_profile(profile: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not profile:
+        return {'sector': 'Unknown', 'pe': None}
+    info = profile.get('info') or {}
+    fundamentals = profile.get('fundamentals') or {}
+    sector = info.get('sector') or info.get('industry') or 'Unknown'
+    pe = fundamentals.get('pe') or fundamentals.get('forward_pe')
+    try:
+        pe = float(pe) if pe is not None else None
+    except Exception:
+        pe = None
+    return {'sector': sector, 'pe': pe}
+
 def _fetch_company_basic(sym: str):
+    # 行业与估值取自公司资料缓存（落盘、按天刷新），与 /api/company 共用
     try:
-        t = yf.Ticker(sym)
-        info = {}
-        try:
-            info = t.get_info() or {}
-        except Exception:
-            try:
-                info = t.info or {}
-            except Exception:
-                info = {}
-        sector = info.get('sector') or info.get('industry') or 'Unknown'
-        pe = info.get('trailingPE') or info.get('forwardPE')
-        if pe is None:
-            pe = info.get('trailing_pe') or info.get('forward_pe')
-        try:
-            pe = float(pe) if pe is not None else None
-        except Exception:
-            pe = None
-        return {'sector': sector, 'pe': pe}
+        profile = _company_cache.get(sym, 'profile', lambda: _load_company_profile(sym))
+        return _company_basic_from_profile(profile)
     except Exception:
         return {'sector': 'Unknown', 'pe': None}
 
+def _fetch_company_basics(symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Sector/PE for many symbols; cache misses are resolved concurrently on the company fetch pool."""
+    syms = list(dict.fromkeys(symbols))
+    futures = {sym: _company_executor.submit(_fetch_company_basic, sym) for sym in syms}
+    wait(futures.values(), timeout=QUOTE_FETCH_TIMEOUT)
+    out = {}
+    for sym, fut in futures.items():
+        if fut.done() and fut.exception() is None:
+            out[sym] = fut.result()
+        else:
+            # 超时：退回到已缓存（可能过期）的资料
+            out[sym] = _company_basic_from_profile(_company_cache.peek(sym, 'profile'))
+    return out
+
 def _sector_concentration(holdings, sector_map):
     weights_by_sector = {}
     for h in holdings:
@@ -605,12 +1683,9 @@ def portfolio_diagnostic():
         weights = [h['weight'] for h in clean]
         diversity_score, hhi = _portfolio_diversity_score(weights)
         single_stock_weight = max(weights) if weights else 0.0
-        sector_map = {}
-        pe_map = {}
-        for h in clean:
-            info = _fetch_company_basic(h['symbol'])
-            sector_map[h['symbol']] = info.get('sector')
-            pe_map[h['symbol']] = info.get('pe')
+        basics = _fetch_company_basics([h['symbol'] for h in clean])
+        sector_map = {sym: info.get('sector') for sym, info in basics.items()}
+        pe_map = {sym: info.get('pe') for sym, info in basics.items()}
         sector_conc, sector_weights = _sector_concentration(clean, sector_map)
         avg_pe = _weighted_avg_pe(clean, pe_map)
         risk_level = _assess_portfolio_risk(single_stock_weight, sector_conc, avg_pe)
@@ -628,6 +1703,16 @@ def portfolio_diagnostic():
             },
             'sector_weights': sector_weights,
         }
+        if data.get('include_risk', True) and clean:
+            try:
+                risk_weights: Dict[str, float] = {}
+                for h in clean:
+                    risk_weights[h['symbol']] = risk_weights.get(h['symbol'], 0.0) + h['weight']
+                # 已落盘的日线直接使用，尾部在后台刷新，诊断接口不等待上游
+                analysis['risk'] = _portfolio_risk_metrics(risk_weights, period=str(data.get('risk_period') or '1y'),
+                                                           stale_ok=True)
+            except Exception as e:
+                analysis['risk'] = {'error': str(e)}
 
         if sector_conc > 0.70:
             analysis['main_issues'].append('Sector concentration is too high')
@@ -664,57 +1749,1449 @@ def portfolio_diagnostic():
         return jsonify({'ok': False, 'error': 'portfolio_diagnostic_failed', 'detail': str(e)}), 500
 
 
+# ----------------------
+# 组合收益分析（服务端对齐 + 向量化计算）
+# ----------------------
+def _request_symbols(data: Dict[str, Any]) -> List[str]:
+    """Symbols from a JSON body given either as ``symbols`` or as ``holdings`` objects."""
+    raw = data.get('symbols') or [h.get('symbol', '') for h in (data.get('holdings') or []) if isinstance(h, dict)]
+    return list(dict.fromkeys(str(s).upper().strip() for s in raw if str(s).strip()))
+
+
+def _aligned_closes(symbols: List[str], period: str = "3mo", interval: str = "1d", fill: bool = False,
+                    join: str = "inner", stale_ok: bool = False) -> pd.DataFrame:
+    """Close prices for all symbols as one bars x symbols frame on a shared date index.
+
+    Histories come from the bar store in one batched call; daily bars are keyed
+    by calendar date so exchanges in different time zones line up. Rows missing
+    any symbol are dropped (inner join) unless ``fill`` carries the last close
+    forward; ``join="outer"`` keeps them, leaving NaN before a symbol's first bar.
+    ``stale_ok`` serves stored bars without waiting for a tail refresh.
+    """
+    histories = _bar_store.history_many(symbols, period, interval, stale_ok=stale_ok)
+    columns = {}
+    for sym in symbols:
+        h = histories.get(sym)
+        if h is None or h.empty or "Close" not in h:
+            continue
+        close = h["Close"].astype(float)
+        idx = pd.DatetimeIndex(close.index)
+        if idx.tz is not None:
+            idx = idx.tz_localize(None)
+        if _is_daily(interval):
+            idx = idx.normalize()
+        close.index = idx
+        columns[sym] = close[~close.index.duplicated(keep="last")]
+    if not columns:
+        return pd.DataFrame()
+    frame = pd.DataFrame(columns).sort_index()
+    if fill:
+        frame = frame.ffill()
+    return frame if join == "outer" else frame.dropna(how="any")
+
+
+RISK_BENCHMARK = "^GSPC"
+TRADING_DAYS = 252
+
+
+def _portfolio_risk_metrics(weights: Dict[str, float], period: str = "1y", benchmark: str = RISK_BENCHMARK,
+                            confidence: float = 0.95, stale_ok: bool = False) -> Dict[str, Any]:
+    """Volatility, VaR/CVaR, max drawdown and beta for a weighted portfolio from daily returns.
+
+    Everything is computed from one bars x assets return matrix and its
+    covariance, so cost is a few matrix products regardless of holding count.
+    VaR/CVaR are one-day losses expressed as positive fractions.
+    """
+    symbols = list(weights)
+    closes = _aligned_closes(symbols + [benchmark], period, fill=True, stale_ok=stale_ok)
+    assets = [s for s in symbols if s in closes.columns]
+    out: Dict[str, Any] = {
+        'benchmark': benchmark, 'confidence': confidence, 'observations': 0, 'symbols': assets,
+        'annual_volatility': None, 'var_hist': None, 'cvar_hist': None, 'var_param': None, 'cvar_param': None,
+        'max_drawdown': None, 'beta': None, 'asset_betas': {},
+    }
+    if not assets:
+        return out
+    prices = closes[assets].to_numpy(dtype=float)
+    returns = prices[1:] / prices[:-1] - 1.0
+    if returns.shape[0] < 3:
+        return out
+    w = np.array([weights[s] for s in assets], dtype=float)
+    w = w / w.sum() if w.sum() > 0 else np.full(len(assets), 1.0 / len(assets))
+    has_bench = benchmark in closes.columns
+    if has_bench:
+        bench = closes[benchmark].to_numpy(dtype=float)
+        returns_all = np.column_stack([returns, bench[1:] / bench[:-1] - 1.0])
+    else:
+        returns_all = returns
+    cov_all = np.atleast_2d(np.cov(returns_all, rowvar=False))
+    n = len(assets)
+    cov = cov_all[:n, :n]
+    port = returns @ w
+    mu = float(port.mean())
+    sigma = float(math.sqrt(max(w @ cov @ w, 0.0)))
+    # 历史模拟法
+    cutoff = float(np.quantile(port, 1.0 - confidence))
+    tail = port[port <= cutoff]
+    # 参数法（正态）
+    z = NormalDist().inv_cdf(confidence)
+    pdf_z = math.exp(-z * z / 2.0) / math.sqrt(2.0 * math.pi)
+    # 最大回撤
+    wealth = np.cumprod(1.0 + port)
+    drawdown = 1.0 - wealth / np.maximum.accumulate(wealth)
+    out.update({
+        'observations': int(returns.shape[0]),
+        'annual_volatility': round(sigma * math.sqrt(TRADING_DAYS), 4),
+        'var_hist': round(-cutoff, 4),
+        'cvar_hist': round(-float(tail.mean()), 4) if tail.size else None,
+        'var_param': round(z * sigma - mu, 4),
+        'cvar_param': round(sigma * pdf_z / (1.0 - confidence) - mu, 4),
+        'max_drawdown': round(float(drawdown.max()), 4),
+    })
+    if has_bench and cov_all[n, n] > 0:
+        betas = cov_all[:n, n] / cov_all[n, n]
+        out['beta'] = round(float(w @ betas), 4)
+        out['asset_betas'] = {s: round(float(b), 4) for s, b in zip(assets, betas)}
+    return out
+
+
+WHATIF_MAX_CANDIDATES = int(os.environ.get("WHATIF_MAX_CANDIDATES", 5000))
+
+
+def _score_weight_matrix(weights: np.ndarray, sectors: List[str], pes: List[Optional[float]]) -> Dict[str, np.ndarray]:
+    """Diagnostic metrics for K candidate weight vectors (K x N) in one vectorized pass.
+
+    Mirrors _portfolio_diversity_score, _sector_concentration, _weighted_avg_pe and
+    _assess_portfolio_risk row by row.
+    """
+    W = np.asarray(weights, dtype=float)
+    totals = W.sum(axis=1, keepdims=True)
+    # 与 _normalize_weights 一致：权重和非正时按等权处理
+    W = np.where(totals > 0, W / np.where(totals > 0, totals, 1.0), 1.0 / max(W.shape[1], 1))
+    hhi = (W ** 2).sum(axis=1)
+    diversity = np.round(np.clip(1.0 - hhi, 0.0, 1.0) * 100.0, 1)
+    single = W.max(axis=1) if W.shape[1] else np.zeros(W.shape[0])
+    sector_names = sorted(set(sectors))
+    onehot = np.array([[1.0 if sec == name else 0.0 for name in sector_names] for sec in sectors]).reshape(len(sectors), len(sector_names))
+    sector_w = W @ onehot
+    # 与 _sector_concentration 一致：先保留 4 位小数再比较阈值
+    sector_conc = np.round(sector_w.max(axis=1), 4) if sector_names else np.zeros(W.shape[0])
+    pe = np.array([np.nan if p is None else float(p) for p in pes], dtype=float)
+    has_pe = ~np.isnan(pe)
+    num = W @ np.where(has_pe, pe, 0.0)
+    den = W @ has_pe.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        avg_pe = np.where(den > 1e-9, np.round(num / den, 2), np.nan)
+    pe0 = np.nan_to_num(avg_pe)
+    high = (single > 0.30) | (sector_conc > 0.70) | (pe0 > 25)
+    medium = (single > 0.20) | (sector_conc > 0.50) | (pe0 > 20)
+    risk = np.where(high, 'High', np.where(medium, 'Medium', 'Low'))
+    return {
+        'weights': W, 'hhi': hhi, 'diversity_score': diversity, 'single_stock_weight': single,
+        'sector_names': np.array(sector_names, dtype=object), 'sector_weights': sector_w,
+        'sector_concentration': sector_conc, 'avg_pe': avg_pe, 'risk_level': risk,
+    }
+
+
+@app.post("/api/portfolio/whatif")
+def portfolio_whatif():
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        symbols = _request_symbols(data)
+        candidates = data.get('candidates') or []
+        if not symbols or not candidates:
+            return jsonify({'ok': False, 'error': 'symbols and candidates are required'}), 400
+        if len(candidates) > WHATIF_MAX_CANDIDATES:
+            return jsonify({'ok': False, 'error': f'at most {WHATIF_MAX_CANDIDATES} candidates per request'}), 400
+        pos = {s: i for i, s in enumerate(symbols)}
+        W = np.zeros((len(candidates), len(symbols)))
+        for k, cand in enumerate(candidates):
+            # 候选权重可以是与 symbols 对齐的数组，也可以是 {symbol: weight}
+            if isinstance(cand, dict):
+                for sym, w in cand.items():
+                    j = pos.get(str(sym).upper().strip())
+                    if j is not None:
+                        W[k, j] += float(w or 0)
+            else:
+                vals = [float(w or 0) for w in cand][:len(symbols)]
+                W[k, :len(vals)] = vals
+        # 元数据只解析一次，所有候选共用
+        basics = _fetch_company_basics(symbols)
+        scores = _score_weight_matrix(W, [basics[s].get('sector') or 'Unknown' for s in symbols],
+                                      [basics[s].get('pe') for s in symbols])
+        sector_names = list(scores['sector_names'])
+        results = []
+        for k in range(W.shape[0]):
+            avg_pe = scores['avg_pe'][k]
+            results.append({
+                'diversity_score': float(scores['diversity_score'][k]),
+                'risk_level': str(scores['risk_level'][k]),
+                'metrics': {
+                    'hhi': round(float(scores['hhi'][k]), 4),
+                    'single_stock_weight': round(float(scores['single_stock_weight'][k]), 4),
+                    'sector_concentration': round(float(scores['sector_concentration'][k]), 4),
+                    'avg_pe': None if np.isnan(avg_pe) else float(avg_pe),
+                },
+                'sector_weights': {name: float(scores['sector_weights'][k, j]) for j, name in enumerate(sector_names)},
+            })
+        return jsonify({'ok': True, 'symbols': symbols,
+                        'metadata': {s: basics[s] for s in symbols}, 'results': results})
+    except Exception as e:
+        return jsonify({'ok': False, 'error': 'portfolio_whatif_failed', 'detail': str(e)}), 500
+
+
+# 组合优化默认约束与 _assess_portfolio_risk 的中等风险阈值一致
+OPTIMIZER_MAX_WEIGHT = 0.20
+OPTIMIZER_MAX_SECTOR_WEIGHT = 0.50
+OPTIMIZER_SHRINKAGE = 0.10
+
+
+def _project_weights(y: np.ndarray, upper: np.ndarray, groups: np.ndarray, caps: np.ndarray) -> np.ndarray:
+    """Euclidean projection onto {0 <= w <= upper, sum(w) = 1, per-group sums <= caps}.
+
+    KKT gives w = clip(y - lam - mu[group], 0, upper). For a given ``lam`` a
+    capped group contributes exactly its cap, so ``lam`` is the root of a
+    monotone piecewise-linear function; it and the per-group shifts ``mu``
+    (solved for all groups at once) are found with bracketed Newton steps.
+    """
+    n_groups = len(caps)
+
+    def group_sums(v: np.ndarray) -> np.ndarray:
+        return np.bincount(groups, weights=v, minlength=n_groups)
+
+    lo, hi = float(y.min() - upper.max() - 1.0), float(y.max())
+    lam = 0.5 * (lo + hi)
+    for _ in range(100):
+        z = y - lam
+        sums = group_sums(np.clip(z, 0.0, upper))
+        capped = sums >= caps
+        excess = float(np.minimum(sums, caps).sum()) - 1.0
+        if abs(excess) < 1e-14:
+            break
+        if excess > 0:
+            lo = lam
+        else:
+            hi = lam
+        slope = int(((z > 0) & (z < upper) & ~capped[groups]).sum())
+        step = lam + excess / slope if slope else None
+        lam = step if step is not None and lo < step < hi else 0.5 * (lo + hi)
+        if hi - lo < 1e-15:
+            break
+    w = np.clip(y - lam, 0.0, upper)
+    over = group_sums(w) > caps
+    if not over.any():
+        return w
+    mlo = np.zeros(n_groups)
+    mhi = np.full(n_groups, max(float(y.max() - lam), 0.0))
+    mu = np.zeros(n_groups)
+    for _ in range(100):
+        z = y - lam - mu[groups]
+        excess = np.where(over, group_sums(np.clip(z, 0.0, upper)) - caps, 0.0)
+        if np.abs(excess).max() < 1e-14:
+            break
+        mlo = np.where(excess > 0, mu, mlo)
+        mhi = np.where(excess < 0, mu, mhi)
+        slope = np.bincount(groups, weights=((z > 0) & (z < upper)).astype(float), minlength=n_groups)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = mu + excess / slope
+        mu = np.where((slope > 0) & (step > mlo) & (step < mhi), step, 0.5 * (mlo + mhi))
+        mu = np.where(over, mu, 0.0)
+    return np.clip(y - lam - mu[groups], 0.0, upper)
+
+
+def _min_variance_weights(cov: np.ndarray, project: Callable[[np.ndarray], np.ndarray],
+                          max_iter: int = 1000, tol: float = 1e-8) -> np.ndarray:
+    """Accelerated projected gradient (FISTA with adaptive restart) on w' cov w."""
+    n = cov.shape[0]
+    step = 1.0 / (2.0 * max(float(np.linalg.eigvalsh(cov)[-1]), 1e-12))
+    w = project(np.full(n, 1.0 / n))
+    x, t = w, 1.0
+    for _ in range(max_iter):
+        w_next = project(x - step * 2.0 * (cov @ x))
+        if np.abs(w_next - w).max() < tol:
+            w = w_next
+            break
+        if (x - w_next) @ (w_next - w) > 0:
+            # 动量方向变差时重启加速
+            x, t = w_next, 1.0
+        else:
+            t_next = 0.5 * (1.0 + math.sqrt(1.0 + 4.0 * t * t))
+            x = w_next + ((t - 1.0) / t_next) * (w_next - w)
+            t = t_next
+        w = w_next
+    return w
+
+
+def _max_sharpe_weights(mu: np.ndarray, cov: np.ndarray, rf: float, start: np.ndarray,
+                        project: Callable[[np.ndarray], np.ndarray], max_iter: int = 1000, tol: float = 1e-8) -> np.ndarray:
+    """Projected gradient ascent with backtracking on the (pseudo-concave) Sharpe ratio."""
+    def sharpe(w: np.ndarray) -> float:
+        return (mu @ w - rf) / math.sqrt(max(w @ cov @ w, 1e-18))
+
+    w, step = start, 0.1
+    best = sharpe(w)
+    for _ in range(max_iter):
+        cw = cov @ w
+        var = max(w @ cw, 1e-18)
+        excess = mu @ w - rf
+        grad = (mu * var - excess * cw) / var ** 1.5
+        while step > 1e-10:
+            cand = project(w + step * grad)
+            val = sharpe(cand)
+            if val > best:
+                break
+            step *= 0.5
+        else:
+            break
+        moved = np.abs(cand - w).max()
+        w, best = cand, val
+        step *= 2.0
+        if moved < tol:
+            break
+    return w
+
+
+def _portfolio_stats(w: np.ndarray, mu: np.ndarray, cov: np.ndarray, rf: float) -> Dict[str, Any]:
+    ret = float(mu @ w)
+    vol = float(math.sqrt(max(w @ cov @ w, 0.0)))
+    return {
+        'expected_return': round(ret, 4),
+        'volatility': round(vol, 4),
+        'sharpe': round((ret - rf) / vol, 4) if vol > 0 else None,
+    }
+
+
+@app.post("/api/portfolio/optimize")
+def portfolio_optimize():
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        symbols = _request_symbols(data)
+        if len(symbols) < 2:
+            return jsonify({'ok': False, 'error': 'at least two symbols are required'}), 400
+        objectives = data.get('objective') or ['min_variance', 'max_sharpe']
+        objectives = [objectives] if isinstance(objectives, str) else list(objectives)
+        unknown = [o for o in objectives if o not in ('min_variance', 'max_sharpe')]
+        if unknown:
+            return jsonify({'ok': False, 'error': f'unknown objective: {", ".join(unknown)}'}), 400
+        rf = float(data.get('risk_free_rate') or 0.0)
+        period = str(data.get('period') or '1y')
+
+        closes = _aligned_closes(symbols, period, fill=True)
+        assets = [s for s in symbols if s in closes.columns]
+        if len(assets) < 2:
+            return jsonify({'ok': False, 'error': 'not enough price history', 'missing': symbols}), 400
+        prices = closes[assets].to_numpy(dtype=float)
+        returns = prices[1:] / prices[:-1] - 1.0
+        if returns.shape[0] < 20:
+            return jsonify({'ok': False, 'error': 'not enough overlapping history'}), 400
+        n = len(assets)
+        mu = returns.mean(axis=0) * TRADING_DAYS
+        sample = np.atleast_2d(np.cov(returns, rowvar=False)) * TRADING_DAYS
+        # 向对角线收缩，样本少于资产数时协方差仍可逆
+        cov = (1.0 - OPTIMIZER_SHRINKAGE) * sample + OPTIMIZER_SHRINKAGE * np.diag(np.diag(sample))
+
+        # 约束：未显式指定时放宽到可行的最小上限
+        explicit_weight = data.get('max_weight') is not None
+        max_weight = float(data['max_weight']) if explicit_weight else max(OPTIMIZER_MAX_WEIGHT, 1.0 / n)
+        if max_weight * n < 1.0 - 1e-9:
+            return jsonify({'ok': False, 'error': f'max_weight {max_weight} is infeasible for {n} assets'}), 400
+        explicit_sector = data.get('max_sector_weight') is not None
+        max_sector = float(data['max_sector_weight']) if explicit_sector else OPTIMIZER_MAX_SECTOR_WEIGHT
+        basics = _fetch_company_basics(assets)
+        sectors = [basics[s].get('sector') or 'Unknown' for s in assets]
+        sector_names = sorted(set(sectors))
+        groups = np.array([sector_names.index(sec) for sec in sectors], dtype=int)
+        sizes = np.bincount(groups, minlength=len(sector_names))
+        capacity = np.minimum(max_sector, sizes * max_weight).sum()
+        sector_relaxed = False
+        if capacity < 1.0 - 1e-9:
+            if explicit_sector:
+                return jsonify({'ok': False, 'error': f'max_sector_weight {max_sector} is infeasible for these sectors'}), 400
+            # 二分求最小可行的行业上限（总容量随上限单调不减，上限为 1 时必然可行）
+            lo, hi = max_sector, 1.0
+            for _ in range(50):
+                mid = 0.5 * (lo + hi)
+                if np.minimum(mid, sizes * max_weight).sum() >= 1.0 - 1e-12:
+                    hi = mid
+                else:
+                    lo = mid
+            max_sector = hi
+            sector_relaxed = True
+        upper = np.full(n, max_weight)
+        caps = np.full(len(sector_names), max_sector)
+
+        def project(y: np.ndarray) -> np.ndarray:
+            return _project_weights(y, upper, groups, caps)
+
+        started = time.time()
+        w_minvar = _min_variance_weights(cov, project)
+        solutions = {}
+        if 'min_variance' in objectives:
+            solutions['min_variance'] = w_minvar
+        if 'max_sharpe' in objectives:
+            solutions['max_sharpe'] = _max_sharpe_weights(mu, cov, rf, w_minvar, project)
+        elapsed_ms = round((time.time() - started) * 1000, 1)
+
+        results = {}
+        for name, w in solutions.items():
+            sector_w = np.bincount(groups, weights=w, minlength=len(sector_names))
+            results[name] = {
+                'weights': {s: round(float(x), 6) for s, x in zip(assets, w)},
+                'sector_weights': {sec: round(float(x), 6) for sec, x in zip(sector_names, sector_w)},
+                **_portfolio_stats(w, mu, cov, rf),
+            }
+        payload = {
+            'ok': True,
+            'symbols': assets,
+            'missing': [s for s in symbols if s not in assets],
+            'constraints': {'max_weight': max_weight, 'max_sector_weight': round(max_sector, 6),
+                            'sector_cap_relaxed': sector_relaxed, 'long_only': True},
+            'observations': int(returns.shape[0]),
+            'solve_ms': elapsed_ms,
+            'results': results,
+        }
+        current = {}
+        for h in data.get('holdings') or []:
+            sym = str(h.get('symbol', '')).upper().strip()
+            if sym in assets:
+                current[sym] = current.get(sym, 0.0) + float(h.get('weight', 0) or 0)
+        if sum(current.values()) > 0:
+            w_cur = np.array([current.get(s, 0.0) for s in assets]) / sum(current.values())
+            payload['current'] = _portfolio_stats(w_cur, mu, cov, rf)
+        return jsonify(payload)
+    except Exception as e:
+        return jsonify({'ok': False, 'error': 'portfolio_optimize_failed', 'detail': str(e)}), 500
+
+
+@app.post("/api/portfolio/correlation")
+def portfolio_correlation():
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        symbols = _request_symbols(data)
+        period = str(data.get('period') or '3mo')
+        closes = _aligned_closes(symbols, period)
+        available = list(closes.columns)
+        matrix = np.full((len(available), len(available)), np.nan)
+        observations = 0
+        if available:
+            # 对数收益 + 一次 corrcoef 得到完整相关矩阵
+            returns = np.diff(np.log(closes.to_numpy(dtype=float)), axis=0)
+            observations = returns.shape[0]
+            if observations >= 3:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    matrix = np.atleast_2d(np.corrcoef(returns, rowvar=False))
+                np.fill_diagonal(matrix, 1.0)
+        return _json_response({
+            'ok': True,
+            'symbols': available,
+            'matrix': _json_array(matrix),
+            'observations': observations,
+            'missing': [s for s in symbols if s not in available],
+            'period': period,
+        })
+    except Exception as e:
+        return jsonify({'ok': False, 'error': 'portfolio_correlation_failed', 'detail': str(e)}), 500
+
+
+@app.post("/api/portfolio/timeseries")
+def portfolio_timeseries():
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        quantities: Dict[str, float] = {}
+        for h in data.get('holdings') or []:
+            sym = str(h.get('symbol', '')).upper().strip()
+            if not sym:
+                continue
+            quantities[sym] = quantities.get(sym, 0.0) + float(h.get('quantity', 0) or 0)
+        period = str(data.get('period') or '3mo')
+        closes = _aligned_closes(list(quantities), period, fill=True)
+        available = list(closes.columns)
+        # bars x holdings 价值矩阵：收盘价逐列乘以持仓数量
+        values = closes.to_numpy(dtype=float) * np.array([quantities[s] for s in available], dtype=float)
+        total = values.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = np.where(total[:, None] > 0, values / total[:, None], np.nan)
+        ts = _index_ms(closes.index)
+        return _json_response({
+            'ok': True,
+            'ts': ts if orjson is not None else ts.tolist(),
+            'symbols': available,
+            'values': {s: _json_array(values[:, i]) for i, s in enumerate(available)},
+            'weights': {s: _json_array(weights[:, i]) for i, s in enumerate(available)},
+            'total': _json_array(total),
+            'missing': [s for s in quantities if s not in available],
+            'period': period,
+        })
+    except Exception as e:
+        return jsonify({'ok': False, 'error': 'portfolio_timeseries_failed', 'detail': str(e)}), 500
+
+
+# ----------------------
+# 策略回测（持仓/收益全部按 symbols × bars 矩阵计算，参数网格用进程池扫描）
+# ----------------------
+BACKTEST_MAX_SYMBOLS = int(os.environ.get("BACKTEST_MAX_SYMBOLS", 200))
+BACKTEST_MAX_COMBOS = int(os.environ.get("BACKTEST_MAX_COMBOS", 1000))
+BACKTEST_WORKERS = int(os.environ.get("BACKTEST_WORKERS", os.cpu_count() or 2))
+BACKTEST_POOL_MIN_COMBOS = int(os.environ.get("BACKTEST_POOL_MIN_COMBOS", 8))
+# 日内按美股常规交易时段 6.5 小时计每日 bar 数（yfinance 的 60m/90m 末尾不足一根也单独成 bar）
+_BARS_PER_YEAR = {"1d": TRADING_DAYS, "5d": TRADING_DAYS / 5, "1wk": 52, "1mo": 12, "3mo": 4,
+                  "1m": TRADING_DAYS * 390, "2m": TRADING_DAYS * 195, "5m": TRADING_DAYS * 78,
+                  "15m": TRADING_DAYS * 26, "30m": TRADING_DAYS * 13, "60m": TRADING_DAYS * 7,
+                  "90m": TRADING_DAYS * 5, "1h": TRADING_DAYS * 7}
+
+# 策略 -> 默认参数；信号规则与 _local_ai_analysis 的 RSI 判断一致
+BACKTEST_STRATEGIES: Dict[str, Dict[str, float]] = {
+    "rsi": {"window": 14, "lower": 30, "upper": 70},
+    "sma_cross": {"fast": 20, "slow": 50},
+    "macd": {"fast": 12, "slow": 26, "signal": 9},
+    "bollinger": {"window": 20, "k": 2.0},
+}
+_BACKTEST_INT_PARAMS = {"window", "fast", "slow", "signal"}
+BACKTEST_STAT_KEYS = ("total_return", "cagr", "volatility", "sharpe", "max_drawdown", "trades", "win_rate",
+                      "exposure", "buy_hold_return")
+# 参数扫描排序方向：+1 越大越好（降序），-1 越小越好（升序）；回撤为负数，越接近 0 越好，按降序
+BACKTEST_RANK_DIRECTION = {key: 1 for key in BACKTEST_STAT_KEYS}
+BACKTEST_RANK_DIRECTION["volatility"] = -1
+
+_backtest_pool: Optional[ProcessPoolExecutor] = None
+_backtest_pool_lock = threading.Lock()
+
+
+def _backtest_params(strategy: str, overrides: Optional[Dict[str, Any]] = None) -> Dict[str, float]:
+    """Defaults for ``strategy`` merged with ``overrides``; raises ValueError on unknown or invalid values."""
+    if strategy not in BACKTEST_STRATEGIES:
+        raise ValueError(f"unknown strategy: {strategy}")
+    params = dict(BACKTEST_STRATEGIES[strategy])
+    for key, value in (overrides or {}).items():
+        if key not in params:
+            raise ValueError(f"unknown parameter for {strategy}: {key}")
+        params[key] = int(value) if key in _BACKTEST_INT_PARAMS else float(value)
+        if key in _BACKTEST_INT_PARAMS and params[key] < 2:
+            raise ValueError(f"{key} must be at least 2")
+    return params
+
+
+def _strategy_signal(strategy: str, closes: np.ndarray, p: Dict[str, float]) -> np.ndarray:
+    """Target position per bar: 1 = be long, 0 = be flat, NaN = keep the previous position."""
+    if strategy == "rsi":
+        r = _rsi(closes, int(p["window"]))
+        return np.where(r <= p["lower"], 1.0, np.where(r >= p["upper"], 0.0, np.nan))
+    if strategy == "sma_cross":
+        fast = _rolling_sum(closes, int(p["fast"])) / p["fast"]
+        slow = _rolling_sum(closes, int(p["slow"])) / p["slow"]
+        return np.where(np.isnan(fast) | np.isnan(slow), np.nan, (fast > slow).astype(float))
+    if strategy == "macd":
+        line = _ema(closes, int(p["fast"])) - _ema(closes, int(p["slow"]))
+        hist = line - _ema(line, int(p["signal"]))
+        return np.where(np.isnan(hist), np.nan, (hist > 0).astype(float))
+    if strategy == "bollinger":
+        mean, std = _rolling_mean_std(closes, int(p["window"]))
+        return np.where(closes < mean - p["k"] * std, 1.0, np.where(closes >= mean, 0.0, np.nan))
+    raise ValueError(f"unknown strategy: {strategy}")
+
+
+def _signal_positions(signal: np.ndarray) -> np.ndarray:
+    """Forward-fill the last non-NaN target along axis 1 (flat before the first signal)."""
+    idx = np.where(np.isnan(signal), 0, np.arange(signal.shape[1]))
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    return np.nan_to_num(np.take_along_axis(signal, idx, axis=1), nan=0.0)
+
+
+def _backtest_matrix(closes: np.ndarray, strategy: str, params: Dict[str, float], fee: float,
+                     bars_per_year: float, curves: bool = False) -> Dict[str, np.ndarray]:
+    """Backtest one parameter set over a symbols x bars close matrix; returns per-symbol stat arrays.
+
+    Signals are taken on the close and the position is held from the next bar,
+    so there is no look-ahead. ``fee`` is charged on every change in position.
+    """
+    n, t = closes.shape
+    valid = ~np.isnan(closes)
+    rets = np.zeros((n, t))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rets[:, 1:] = closes[:, 1:] / closes[:, :-1] - 1.0
+    rets = np.where(np.isfinite(rets), rets, 0.0)
+    held = np.zeros((n, t))
+    held[:, 1:] = _signal_positions(_strategy_signal(strategy, closes, params))[:, :-1]
+    change = np.diff(held, axis=1, prepend=0.0)
+    strat = held * rets - np.abs(change) * fee
+    equity = np.cumprod(1.0 + strat, axis=1)
+    drawdown = equity / np.maximum.accumulate(equity, axis=1) - 1.0
+
+    bars = valid.sum(axis=1)
+    final = equity[:, -1] if t else np.ones(n)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        years = bars / bars_per_year
+        cagr = np.where(years > 0, final ** (1.0 / years) - 1.0, np.nan)
+        mean = (strat * valid).sum(axis=1) / bars
+        std = np.sqrt((((strat - mean[:, None]) ** 2) * valid).sum(axis=1) / (bars - 1))
+        sharpe = np.where(std > 0, mean / std * math.sqrt(bars_per_year), np.nan)
+        # 按交易编号聚合对数收益，得到每笔交易盈亏
+        entries = change > 0
+        trade_id = np.cumsum(entries, axis=1)
+        in_trade = held > 0
+        keys = (np.arange(n)[:, None] * (t + 1) + trade_id)[in_trade]
+        pnl = np.bincount(keys, weights=np.log1p(strat[in_trade]), minlength=n * (t + 1)).reshape(n, t + 1)
+        counted = np.bincount(keys, minlength=n * (t + 1)).reshape(n, t + 1) > 0
+        trades = counted.sum(axis=1)
+        win_rate = np.where(trades > 0, (counted & (pnl > 0)).sum(axis=1) / trades, np.nan)
+        out = {
+            "total_return": final - 1.0,
+            "cagr": cagr,
+            "volatility": std * math.sqrt(bars_per_year),
+            "sharpe": sharpe,
+            "max_drawdown": drawdown.min(axis=1) if t else np.zeros(n),
+            "trades": trades.astype(float),
+            "win_rate": win_rate,
+            "exposure": (in_trade & valid).sum(axis=1) / bars,
+            "buy_hold_return": np.prod(1.0 + rets, axis=1) - 1.0,
+        }
+    if curves:
+        out["equity"] = np.where(valid, equity, np.nan)
+        out["position"] = held
+    return out
+
+
+def _backtest_sweep_chunk(closes: np.ndarray, strategy: str, combos: List[Dict[str, float]], fee: float,
+                          bars_per_year: float) -> List[Dict[str, np.ndarray]]:
+    """Process-pool entry point: stats for several parameter sets over the same close matrix."""
+    return [_backtest_matrix(closes, strategy, p, fee, bars_per_year) for p in combos]
+
+
+def _get_backtest_pool() -> ProcessPoolExecutor:
+    global _backtest_pool
+    with _backtest_pool_lock:
+        if _backtest_pool is None:
+            # spawn：避免在已有行情线程的进程里 fork
+            _backtest_pool = ProcessPoolExecutor(max_workers=BACKTEST_WORKERS,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return _backtest_pool
+
+
+def _backtest_sweep(closes: np.ndarray, strategy: str, combos: List[Dict[str, float]], fee: float,
+                    bars_per_year: float) -> List[Dict[str, np.ndarray]]:
+    """Run every parameter set, fanning chunks out to the process pool when the grid is large enough."""
+    global _backtest_pool
+    if len(combos) < BACKTEST_POOL_MIN_COMBOS or BACKTEST_WORKERS <= 1:
+        return _backtest_sweep_chunk(closes, strategy, combos, fee, bars_per_year)
+    size = max(1, math.ceil(len(combos) / (BACKTEST_WORKERS * 4)))
+    chunks = [combos[i:i + size] for i in range(0, len(combos), size)]
+    try:
+        pool = _get_backtest_pool()
+        futures = [pool.submit(_backtest_sweep_chunk, closes, strategy, c, fee, bars_per_year) for c in chunks]
+        return [stats for f in futures for stats in f.result()]
+    except Exception as e:
+        # 进程池异常（例如子进程被杀）时丢弃进程池，本次在当前进程内完成
+        print(f"Backtest pool error, running inline: {e}")
+        with _backtest_pool_lock:
+            _backtest_pool = None
+        return _backtest_sweep_chunk(closes, strategy, combos, fee, bars_per_year)
+
+
+def _backtest_summary(stats: Dict[str, np.ndarray]) -> Dict[str, Optional[float]]:
+    """Cross-symbol mean of each stat, ignoring symbols where it is undefined."""
+    out = {}
+    for key in BACKTEST_STAT_KEYS:
+        col = stats[key][np.isfinite(stats[key])]
+        out[key] = round(float(col.mean()), 6) if col.size else None
+    return out
+
+
+def _backtest_symbol_stats(stats: Dict[str, np.ndarray], i: int) -> Dict[str, Optional[float]]:
+    def v(key: str) -> Optional[float]:
+        x = float(stats[key][i])
+        return round(x, 6) if math.isfinite(x) else None
+    return {key: v(key) for key in BACKTEST_STAT_KEYS}
+
+
+@app.post("/api/backtest")
+def backtest():
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        symbols = _request_symbols(data)[:BACKTEST_MAX_SYMBOLS]
+        if not symbols:
+            return jsonify({'ok': False, 'error': 'symbols are required'}), 400
+        strategy = str(data.get('strategy') or 'rsi')
+        period = str(data.get('period') or '2y')
+        interval = str(data.get('interval') or '1d')
+        if interval not in _BARS_PER_YEAR:
+            return jsonify({'ok': False, 'error': f'unknown interval: {interval}'}), 400
+        fee = float(data.get('fee_bps') or 0.0) / 10000.0
+        rank_by = str(data.get('rank_by') or 'sharpe')
+        if rank_by not in BACKTEST_STAT_KEYS:
+            return jsonify({'ok': False, 'error': f'unknown rank_by: {rank_by}'}), 400
+        grid = data.get('param_grid') or {}
+        if not isinstance(grid, dict):
+            return jsonify({'ok': False, 'error': 'param_grid must be an object of parameter -> values'}), 400
+        try:
+            base = _backtest_params(strategy, data.get('params'))
+            keys = list(grid)
+            values = [v if isinstance(v, list) else [v] for v in grid.values()]
+            count = math.prod(len(v) for v in values)
+            if count > BACKTEST_MAX_COMBOS:
+                return jsonify({'ok': False, 'error': f'param_grid has {count} combinations (max {BACKTEST_MAX_COMBOS})'}), 400
+            combos = [_backtest_params(strategy, {**base, **dict(zip(keys, combo))})
+                      for combo in itertools.product(*values)]
+        except (TypeError, ValueError) as e:
+            return jsonify({'ok': False, 'error': str(e)}), 400
+
+        frame = _aligned_closes(symbols, period, interval, fill=True, join="outer")
+        available = list(frame.columns)
+        if not available:
+            return jsonify({'ok': False, 'error': 'no price history', 'missing': symbols}), 400
+        closes = frame.to_numpy(dtype=float).T
+        bars_per_year = _BARS_PER_YEAR[interval]
+
+        started = time.time()
+        sweep = None
+        params = combos[0]
+        if grid:
+            all_stats = _backtest_sweep(closes, strategy, combos, fee, bars_per_year)
+            summaries = [_backtest_summary(s) for s in all_stats]
+            sign = BACKTEST_RANK_DIRECTION[rank_by]
+            order = sorted(range(len(combos)), key=lambda i: (summaries[i][rank_by] is None,
+                                                             -sign * (summaries[i][rank_by] or 0.0)))
+            sweep = [{'params': combos[i], **summaries[i]} for i in order]
+            params = combos[order[0]]
+        stats = _backtest_matrix(closes, strategy, params, fee, bars_per_year, curves=True)
+        elapsed_ms = round((time.time() - started) * 1000, 1)
+
+        ts = _index_ms(frame.index)
+        payload = {
+            'ok': True,
+            'strategy': strategy,
+            'params': params,
+            'period': period,
+            'interval': interval,
+            'symbols': available,
+            'missing': [s for s in symbols if s not in available],
+            'ts': ts if orjson is not None else ts.tolist(),
+            'summary': _backtest_summary(stats),
+            'results': {
+                s: {**_backtest_symbol_stats(stats, i),
+                    'equity': _json_array(stats['equity'][i]),
+                    'position': _json_array(stats['position'][i])}
+                for i, s in enumerate(available)
+            },
+            'elapsed_ms': elapsed_ms,
+        }
+        if sweep is not None:
+            payload['rank_by'] = rank_by
+            payload['rank_order'] = 'desc' if BACKTEST_RANK_DIRECTION[rank_by] > 0 else 'asc'
+            payload['combinations'] = len(combos)
+            payload['sweep'] = sweep
+        return _json_response(payload)
+    except Exception as e:
+        return jsonify({'ok': False, 'error': 'backtest_failed', 'detail': str(e)}), 500
+
+
+# ----------------------
+# 市场筛选器（后台定期重建的列式快照，过滤/排序全部是数组运算）
+# ----------------------
+SCREENER_REBUILD_INTERVAL = float(os.environ.get("SCREENER_REBUILD_INTERVAL", 60))
+SCREENER_MAX_LIMIT = 1000
+SCREENER_QUOTE_FIELDS = ("price", "change", "change_percent", "volume", "market_cap", "year_high", "year_low")
+SCREENER_FIELDS = SCREENER_QUOTE_FIELDS + INDICATOR_KEYS + ("pe", "signal_score")
+_SCREENER_OPS: Dict[str, Callable[[np.ndarray, Any], np.ndarray]] = {
+    "<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal, "=": np.equal, "==": np.equal,
+    "!=": np.not_equal,
+}
+
+
+def _screener_universe() -> Tuple[List[str], Dict[str, List[str]]]:
+    """Every symbol the app knows about plus index membership (index symbol -> constituents)."""
+    members = {idx["symbol"]: list(idx.get("constituents") or []) for idx in INDICES}
+    syms = [idx["symbol"] for idx in INDICES] + [s for m in members.values() for s in m]
+    syms += HOT_LIST + list(_load_watchlist())
+    return list(dict.fromkeys(s.upper() for s in syms)), members
+
+
+def _quote_row(q: Dict[str, Any]) -> List[Optional[float]]:
+    ind = q.get("indicators") or {}
+    macd = ind.get("macd") or {}
+    bb = ind.get("bbands") or {}
+    nested = {
+        "sma20": ind.get("sma20"), "sma50": ind.get("sma50"), "rsi14": ind.get("rsi14"),
+        "macd": macd.get("macd"), "macd_signal": macd.get("signal"), "macd_hist": macd.get("hist"),
+        "bb_upper": bb.get("upper"), "bb_middle": bb.get("middle"), "bb_lower": bb.get("lower"),
+    }
+    return [q.get(k) for k in SCREENER_QUOTE_FIELDS] + [nested[k] for k in INDICATOR_KEYS]
+
+
+class PeriodicSnapshot:
+    """Immutable snapshot rebuilt by a daemon thread every ``interval`` seconds.
+
+    Subclasses implement ``build()``; the result is swapped in atomically, so
+    readers never lock and never wait on upstream once the first build is done.
+    """
+
+    def __init__(self, interval: float, name: str):
+        self.interval = interval
+        self.name = name
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._build_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # 后台线程完成首次构建（无论成败）后置位，冷启动的读者在此等待
+        self._first_attempt = threading.Event()
+        self._error: Optional[str] = None
+
+    def build(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-rebuild", daemon=True)
+        self._thread.start()
+
+    def rebuild(self) -> Dict[str, Any]:
+        with self._build_lock:
+            started = time.time()
+            snap = self.build()
+            snap["built_at"] = int(time.time() * 1000)
+            snap["build_ms"] = round((time.time() - started) * 1000, 1)
+            self._snapshot = snap
+            return snap
+
+    def snapshot(self) -> Dict[str, Any]:
+        snap = self._snapshot
+        if snap is None:
+            # 冷启动（例如未通过 __main__ 启动）：拉起后台线程并等待它的首次构建，
+            # 并发的冷请求共享这一次构建
+            self.start()
+            self._first_attempt.wait()
+            snap = self._snapshot
+            if snap is None:
+                raise RuntimeError(f"{self.name} snapshot unavailable: {self._error}")
+            return snap
+        if time.time() * 1000 - snap["built_at"] > self.interval * 2000:
+            # 后台线程已退出时按需重新拉起
+            self.start()
+        return snap
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.rebuild()
+                self._error = None
+            except Exception as e:
+                self._error = str(e)
+                print(f"{self.name} rebuild error: {e}")
+            finally:
+                self._first_attempt.set()
+            time.sleep(self.interval)
+
+
+class MarketScreener(PeriodicSnapshot):
+    """Columnar snapshot of the whole symbol universe: one numpy array per field.
+
+    Quotes come from the quote cache (kept warm by the refresher); only
+    never-seen symbols are fetched.
+    """
+
+    def build(self) -> Dict[str, Any]:
+        syms, members = _screener_universe()
+        quotes: Dict[str, Dict[str, Any]] = {}
+        missing = []
+        for sym in syms:
+            q = _quote_cache.get(sym)
+            if q is None:
+                q = _quote_cache.get_stale(sym)
+            if q is None:
+                missing.append(sym)
+            else:
+                quotes[sym] = q
+        if missing:
+            # 不经过 _get_prices_for_symbols，避免把整个全集标记为"最近访问"
+            quotes.update(_fetch_quotes(missing))
+        basics = _fetch_company_basics(syms)
+        columns = _signal_columns([quotes.get(s) or {} for s in syms], [basics[s].get("pe") for s in syms])
+        signals = _evaluate_signal_rules(columns)
+        columns["signal_score"] = signals.astype(float) @ _SIGNAL_SCORES
+        index_of = {s: i for i, s in enumerate(syms)}
+        membership = {}
+        for idx_sym, constituents in members.items():
+            mask = np.zeros(len(syms), dtype=bool)
+            mask[[index_of[c.upper()] for c in constituents]] = True
+            membership[idx_sym] = mask
+        sectors = [basics[s].get("sector") or "Unknown" for s in syms]
+        return {
+            "symbols": np.array(syms, dtype=object),
+            "sectors": np.array(sectors, dtype=object),
+            "sector_keys": np.array([s.lower() for s in sectors]),
+            "columns": columns,
+            "signals": signals,
+            "membership": membership,
+        }
+
+
+_screener = MarketScreener(SCREENER_REBUILD_INTERVAL, name="screener")
+
+
+def _parse_screener_filters(where: str) -> List[Tuple[str, str, Any]]:
+    """Parse ``rsi14<30,price>sma50`` into (field, op, number-or-field) triples."""
+    filters = []
+    for clause in (c.strip() for c in where.split(",")):
+        if not clause:
+            continue
+        for op in ("<=", ">=", "==", "!=", "<", ">", "="):
+            if op in clause:
+                field, rhs = (x.strip() for x in clause.split(op, 1))
+                break
+        else:
+            raise ValueError(f"invalid filter: {clause}")
+        if field not in SCREENER_FIELDS:
+            raise ValueError(f"unknown field: {field}")
+        if rhs not in SCREENER_FIELDS:
+            try:
+                rhs = float(rhs)
+            except ValueError:
+                raise ValueError(f"invalid value in filter: {clause}")
+        filters.append((field, op, rhs))
+    return filters
+
+
+def _screen(snap: Dict[str, Any], filters: List[Tuple[str, str, Any]], sectors: Optional[List[str]] = None,
+            index: Optional[str] = None, sort: Optional[str] = None, limit: int = 50,
+            signals: Optional[List[str]] = None) -> Tuple[np.ndarray, int]:
+    """Row indices of the snapshot matching every filter, sorted, plus the total match count."""
+    cols = snap["columns"]
+    mask = np.ones(len(snap["symbols"]), dtype=bool)
+    with np.errstate(invalid="ignore"):
+        for field, op, rhs in filters:
+            other = cols[rhs] if isinstance(rhs, str) else rhs
+            # 缺数据的代码不参与比较（NaN 在 != 下会被判为 True，需显式排除）
+            mask &= _SCREENER_OPS[op](cols[field], other) & ~np.isnan(cols[field]) & ~np.isnan(other)
+    if sectors:
+        mask &= np.isin(snap["sector_keys"], [s.lower() for s in sectors])
+    if index:
+        mask &= snap["membership"].get(index, np.zeros_like(mask))
+    if signals:
+        mask &= snap["signals"][:, [SIGNAL_IDS.index(sig) for sig in signals]].all(axis=1)
+    rows = np.flatnonzero(mask)
+    if sort:
+        field = sort.lstrip("-")
+        values = cols[field][rows]
+        key = np.where(np.isnan(values), np.inf, -values if sort.startswith("-") else values)
+        rows = rows[np.argsort(key, kind="stable")]
+    return rows[:limit], int(mask.sum())
+
+
+@app.get("/api/screener")
+def screener():
+    try:
+        filters = _parse_screener_filters(request.args.get("where", ""))
+        sort = request.args.get("sort") or None
+        if sort and sort.lstrip("-") not in SCREENER_FIELDS:
+            raise ValueError(f"unknown sort field: {sort.lstrip('-')}")
+        limit = max(1, min(int(request.args.get("limit", 50)), SCREENER_MAX_LIMIT))
+        signals = [x.strip() for x in request.args.get("signal", "").split(",") if x.strip()] or None
+        unknown = [x for x in signals or [] if x not in SIGNAL_IDS]
+        if unknown:
+            raise ValueError(f"unknown signal: {', '.join(unknown)}")
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    sectors = [s.strip() for s in request.args.get("sector", "").split(",") if s.strip()] or None
+    index = (request.args.get("index") or "").upper().strip() or None
+    try:
+        started = time.time()
+        snap = _screener.snapshot()
+        rows, matched = _screen(snap, filters, sectors, index, sort, limit, signals)
+        # 先按列切片再转置成行，避免逐单元格取值
+        keys = ("symbol", "sector") + SCREENER_FIELDS + ("signals",)
+        columns = [snap["symbols"][rows].tolist(), snap["sectors"][rows].tolist()]
+        for k in SCREENER_FIELDS:
+            col = snap["columns"][k][rows]
+            columns.append(np.where(np.isnan(col), None, col).tolist())
+        columns.append([[SIGNAL_IDS[j] for j in np.flatnonzero(row)] for row in snap["signals"][rows]])
+        results = [dict(zip(keys, row)) for row in zip(*columns)]
+        return jsonify({
+            "ok": True,
+            "results": results,
+            "matched": matched,
+            "universe": len(snap["symbols"]),
+            "built_at": snap["built_at"],
+            "query_ms": round((time.time() - started) * 1000, 2),
+        })
+    except Exception as e:
+        return jsonify({"ok": False, "error": "screener_failed", "detail": str(e)}), 500
+
+
+# ----------------------
+# 本地信号规则引擎（规则表 + NumPy 掩码，对任意数量代码一次性求值）
+# ----------------------
+# (id, section, score, text, conditions)；conditions 为 None 表示"同一 section 内其他规则都未触发时"
+# score > 0 偏多，< 0 偏空；缺失数据（NaN）的条件一律不触发
+SIGNAL_RULES: Tuple[Tuple[str, str, int, str, Optional[Tuple[Tuple[str, str, Any], ...]]], ...] = (
+    ("rsi_oversold", "technical", 1, "RSI low; strong oversold conditions", (("rsi14", "<=", 30),)),
+    ("rsi_overbought", "technical", -1, "RSI high; overbought risk", (("rsi14", ">=", 70),)),
+    ("rsi_neutral", "technical", 0, "RSI neutral", (("rsi14", ">", 30), ("rsi14", "<", 70))),
+    ("rsi_invalid", "technical", 0, "RSI data limited", (("rsi_invalid", ">", 0),)),
+    ("momentum_up", "technical", 1, "Short-term upward momentum is strong", (("change_percent", ">=", 2),)),
+    ("pullback", "technical", -1, "Short-term pullback pressure is notable", (("change_percent", "<=", -2),)),
+    ("above_sma50", "technical", 1, "Price above SMA50; trend intact", (("price", ">", "sma50"),)),
+    ("below_sma50", "technical", -1, "Price below SMA50; trend weak", (("price", "<", "sma50"),)),
+    ("macd_bullish", "technical", 1, "MACD above signal", (("macd_hist", ">", 0),)),
+    ("macd_bearish", "technical", -1, "MACD below signal", (("macd_hist", "<", 0),)),
+    ("below_lower_band", "technical", 1, "Price below lower Bollinger band", (("price", "<", "bb_lower"),)),
+    ("above_upper_band", "technical", -1, "Price above upper Bollinger band", (("price", ">", "bb_upper"),)),
+    ("pe_high", "risk", -1, "Valuation is high; volatility may amplify", (("pe", ">=", 30),)),
+    ("pe_low", "risk", 0, "Valuation is low; fundamentals need confirmation", (("pe", "<=", 10),)),
+    ("event_risk", "risk", 0, "Mind event risk and market environment", ()),
+    ("accumulate", "action", 0, "Start with a small position; scale in gradually", (("rsi14", "<=", 30),)),
+    ("trim", "action", 0, "Trim positions cautiously; wait for a pullback", (("rsi14", ">=", 70),)),
+    ("risk_control", "action", 0, "Prioritize risk control; set stop-loss levels", (("rsi_invalid", ">", 0),)),
+    ("wait", "action", 0, "Stay on the sidelines; watch support and volume", None),
+)
+SIGNAL_IDS = tuple(r[0] for r in SIGNAL_RULES)
+_SIGNAL_SECTIONS = (("technical", "Technical"), ("risk", "Risk"), ("action", "Action"))
+_SIGNAL_SCORES = np.array([r[2] for r in SIGNAL_RULES], dtype=float)
+
+
+def _evaluate_signal_rules(columns: Dict[str, np.ndarray]) -> np.ndarray:
+    """Boolean symbols x rules matrix of fired rules for column arrays keyed by field name."""
+    n = len(next(iter(columns.values())))
+    fired = np.zeros((n, len(SIGNAL_RULES)), dtype=bool)
+    with np.errstate(invalid="ignore"):
+        for j, (_, _, _, _, conditions) in enumerate(SIGNAL_RULES):
+            if conditions is None:
+                continue
+            mask = np.ones(n, dtype=bool)
+            for field, op, rhs in conditions:
+                lhs = columns.get(field, np.full(n, np.nan))
+                other = columns.get(rhs, np.full(n, np.nan)) if isinstance(rhs, str) else rhs
+                mask &= _SCREENER_OPS[op](lhs, other) & ~np.isnan(lhs) & ~np.isnan(other)
+            fired[:, j] = mask
+    for j, (_, section, _, _, conditions) in enumerate(SIGNAL_RULES):
+        if conditions is None:
+            others = [k for k, r in enumerate(SIGNAL_RULES) if r[1] == section and r[4] is not None]
+            fired[:, j] = ~fired[:, others].any(axis=1)
+    return fired
+
+
+def _signal_texts(fired: np.ndarray) -> List[str]:
+    """Readable summary per symbol; built once per distinct fired pattern rather than per symbol."""
+    if fired.shape[0] == 0:
+        return []
+    patterns, inverse = np.unique(fired, axis=0, return_inverse=True)
+    texts = []
+    for pattern in patterns:
+        parts = []
+        for section, label in _SIGNAL_SECTIONS:
+            items = [SIGNAL_RULES[j][3] for j in np.flatnonzero(pattern) if SIGNAL_RULES[j][1] == section]
+            if items:
+                parts.append(f"{label}: " + ", ".join(items))
+        texts.append("; ".join(parts))
+    return [texts[i] for i in np.asarray(inverse).ravel()]
+
+
+def _signal_summary(fired: np.ndarray) -> Dict[str, Any]:
+    """Score, bias, fired rule ids and text for every row of a fired matrix."""
+    score = fired.astype(float) @ _SIGNAL_SCORES
+    bias = np.where(score > 0, "bullish", np.where(score < 0, "bearish", "neutral"))
+    return {
+        "score": score,
+        "bias": bias,
+        "signals": [[SIGNAL_IDS[j] for j in np.flatnonzero(row)] for row in fired],
+        "text": _signal_texts(fired),
+    }
+
+
+def _signal_columns(quotes: List[Dict[str, Any]], pes: List[Any]) -> Dict[str, np.ndarray]:
+    width = len(SCREENER_QUOTE_FIELDS) + len(INDICATOR_KEYS)
+    rows = np.array([_quote_row(q) for q in quotes], dtype=float).reshape(len(quotes), width)
+    columns = {k: rows[:, i] for i, k in enumerate(SCREENER_QUOTE_FIELDS + INDICATOR_KEYS)}
+    columns["pe"] = np.array([_finite(p) for p in pes], dtype=float)
+    return columns
+
+
+@app.get("/api/signals")
+def get_signals():
+    try:
+        if request.args.get("universe") in ("1", "true"):
+            snap = _screener.snapshot()
+            symbols = snap["symbols"].tolist()
+            fired = snap["signals"]
+        else:
+            symbols_param = request.args.get("symbols")
+            if symbols_param:
+                symbols = list(dict.fromkeys(s.strip().upper() for s in symbols_param.split(",") if s.strip()))
+            else:
+                symbols = _load_watchlist()
+            quotes = _get_prices_for_symbols(symbols)
+            basics = _fetch_company_basics(symbols)
+            fired = _evaluate_signal_rules(_signal_columns(quotes, [basics[s].get("pe") for s in symbols]))
+        summary = _signal_summary(fired)
+        return jsonify({
+            "ok": True,
+            "rules": [{"id": r[0], "section": r[1], "score": r[2], "text": r[3]} for r in SIGNAL_RULES],
+            "results": [
+                {"symbol": sym, "score": int(summary["score"][i]), "bias": str(summary["bias"][i]),
+                 "signals": summary["signals"][i], "text": summary["text"][i]}
+                for i, sym in enumerate(symbols)
+            ],
+        })
+    except Exception as e:
+        return jsonify({"ok": False, "error": "signals_failed", "detail": str(e)}), 500
+
+
+# ----------------------
+# 行业广度与相对强弱（后台定期基于一次批量历史数据重算）
+# ----------------------
+SECTOR_ANALYTICS_INTERVAL = float(os.environ.get("SECTOR_ANALYTICS_INTERVAL", 300))
+SECTOR_RS_WINDOWS = {"1w": 5, "1m": 21, "3m": 63}
+
+
+class SectorAnalytics(PeriodicSnapshot):
+    """Breadth and relative strength for every sector ETF in INDICES.
+
+    One bar-store load covers all ETFs, their constituents and the benchmark;
+    per-sector aggregates are a membership matrix (sectors x symbols) times
+    per-symbol indicator vectors.
+    """
+
+    def build(self) -> Dict[str, Any]:
+        sectors = [i for i in INDICES if i.get("category") == "sector_etf"]
+        symbols = list(dict.fromkeys([RISK_BENCHMARK] + [i["symbol"] for i in sectors]
+                                     + [s for i in sectors for s in i["constituents"]]))
+        frame = _aligned_closes(symbols, "6mo", fill=True, join="outer")
+        cols = list(frame.columns)
+        closes = frame.to_numpy(dtype=float).T
+        pos = {s: j for j, s in enumerate(cols)}
+
+        arrays = _indicator_arrays(closes)
+        last, prev = closes[:, -1], closes[:, -2] if closes.shape[1] > 1 else np.full(len(cols), np.nan)
+        with np.errstate(invalid="ignore"):
+            day = last - prev
+            advancing = day > 0
+            declining = day < 0
+            above20 = last > arrays["sma20"][:, -1]
+            above50 = last > arrays["sma50"][:, -1]
+        has_day = ~np.isnan(day)
+        has20 = ~np.isnan(arrays["sma20"][:, -1])
+        has50 = ~np.isnan(arrays["sma50"][:, -1])
+        rsi = arrays["rsi14"][:, -1]
+
+        member = np.zeros((len(sectors), len(cols)))
+        for g, sec in enumerate(sectors):
+            member[g, [pos[s] for s in sec["constituents"] if s in pos]] = 1.0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            counts = member @ has_day
+            adv = member @ advancing
+            dec = member @ declining
+            pct20 = (member @ (above20 & has20)) / (member @ has20)
+            pct50 = (member @ (above50 & has50)) / (member @ has50)
+            avg_rsi = (member @ np.nan_to_num(rsi)) / (member @ ~np.isnan(rsi))
+
+            etf_rows = np.array([pos.get(sec["symbol"], -1) for sec in sectors])
+            bench = pos.get(RISK_BENCHMARK)
+            rs = {}
+            for label, window in SECTOR_RS_WINDOWS.items():
+                if closes.shape[1] <= window:
+                    rs[label] = np.full(len(sectors), np.nan)
+                    continue
+                growth = closes[:, -1] / closes[:, -1 - window]
+                bench_growth = growth[bench] if bench is not None else np.nan
+                rs[label] = np.where(etf_rows >= 0, growth[etf_rows] / bench_growth - 1.0, np.nan)
+            etf_change = np.where(etf_rows >= 0, day[etf_rows] / prev[etf_rows] * 100.0, np.nan)
+
+        def num(x: float, digits: int = 4) -> Optional[float]:
+            return round(float(x), digits) if np.isfinite(x) else None
+
+        rows = []
+        for g, sec in enumerate(sectors):
+            rows.append({
+                "symbol": sec["symbol"],
+                "name": sec["name"],
+                "constituents": len(sec["constituents"]),
+                "change_percent": num(etf_change[g]),
+                "advancers": int(adv[g]),
+                "decliners": int(dec[g]),
+                "unchanged": int(counts[g] - adv[g] - dec[g]),
+                "ad_ratio": num(adv[g] / dec[g]) if dec[g] else None,
+                "pct_above_sma20": num(pct20[g]),
+                "pct_above_sma50": num(pct50[g]),
+                "avg_rsi14": num(avg_rsi[g], 2),
+                "relative_strength": {label: num(v[g]) for label, v in rs.items()},
+            })
+        as_of = int(_index_ms(frame.index)[-1]) if len(frame.index) else None
+        return {"sectors": rows, "benchmark": RISK_BENCHMARK, "as_of": as_of}
+
+
+_sector_analytics = SectorAnalytics(SECTOR_ANALYTICS_INTERVAL, name="sector-analytics")
+
+
+@app.get("/api/sectors")
+def get_sectors():
+    try:
+        snap = _sector_analytics.snapshot()
+        return jsonify({"ok": True, **snap})
+    except Exception as e:
+        return jsonify({"ok": False, "error": "sector_analytics_failed", "detail": str(e)}), 500
+
+
 # ---- AI 分析接口（DeepSeek/OpenAI兼容HTTP） ----
-def _call_deepseek_chat(system_msg: str, user_msg: str) -> Dict[str, Any]:
-    api_key = os.environ.get("DEEPSEEK_API_KEY") or os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        return {"error": "API key not configured. Set DEEPSEEK_API_KEY."}
-    url = "https://api.deepseek.com/v1/chat/completions"
+# 可指向本地兼容服务（测试/自建网关），如 LLM_BASE_URL=http://127.0.0.1:8001/v1
+LLM_BASE_URL = os.environ.get("LLM_BASE_URL", "https://api.deepseek.com/v1")
+LLM_MODEL = os.environ.get("LLM_MODEL", "deepseek-chat")
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 15))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 4))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 5))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 2))
+LLM_BACKOFF = float(os.environ.get("LLM_BACKOFF", 0.5))
+_LLM_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class UpstreamHTTPError(Exception):
+    def __init__(self, status: int, body: str):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status = status
+        self.body = body
+
+
+class UpstreamBusyError(Exception):
+    pass
+
+
+class PooledHTTPClient:
+    """Keep-alive HTTP(S) connections to one base URL, shared by every request thread.
+
+    At most ``max_concurrency`` requests are in flight (further callers wait up
+    to ``queue_timeout``); idle connections are reused so later calls skip the
+    TCP/TLS handshake. Connection errors, 429 and 5xx are retried with
+    exponential backoff and jitter, honouring ``Retry-After``; timeouts are not
+    retried so a slow upstream cannot multiply request latency.
+    """
+
+    def __init__(self, base_url: str, timeout: float, max_concurrency: int, queue_timeout: float,
+                 max_retries: int, backoff: float):
+        parts = urllib.parse.urlsplit(base_url)
+        self.scheme = parts.scheme or "https"
+        self.host = parts.hostname or ""
+        self.port = parts.port
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.connections = 0
+
+    def _checkout(self) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+            self.connections += 1
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout), False
+
+    def _checkin(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            self._idle.append(conn)
+
+    def _delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        try:
+            if retry_after is not None:
+                return min(float(retry_after), self.timeout)
+        except ValueError:
+            pass
+        return self.backoff * (2 ** attempt) * (0.5 + random.random())
+
+    def _open(self, path: str, payload: Dict[str, Any],
+              headers: Optional[Dict[str, str]]) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        """Send the request (retrying as described above) and return a successful, unread response."""
+        body = json.dumps(payload).encode("utf-8")
+        hdrs = {"Content-Type": "application/json", "Connection": "keep-alive", **(headers or {})}
+        attempt = 0
+        while True:
+            conn, reused = self._checkout()
+            with self._lock:
+                self.requests += 1
+            try:
+                conn.request("POST", self.base_path + path, body=body, headers=hdrs)
+                resp = conn.getresponse()
+            except TimeoutError:
+                conn.close()
+                raise
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # 复用的空闲连接可能已被服务端关闭：立即换新连接重试，不计入重试次数
+                if reused:
+                    continue
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self._delay(attempt))
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                continue
+            if resp.status < 400:
+                return conn, resp
+            data = self._finish(conn, resp)
+            if resp.status in _LLM_RETRY_STATUS and attempt < self.max_retries:
+                time.sleep(self._delay(attempt, resp.getheader("Retry-After")))
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                continue
+            raise UpstreamHTTPError(resp.status, data.decode("utf-8", errors="replace"))
+
+    def _finish(self, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse) -> bytes:
+        """Read the rest of the body and return the connection to the idle pool when it can be reused."""
+        try:
+            data = resp.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._checkin(conn)
+        return data
+
+    def post_json(self, path: str, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> Any:
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise UpstreamBusyError("too many concurrent upstream requests")
+        try:
+            conn, resp = self._open(path, payload, headers)
+            return json.loads(self._finish(conn, resp).decode("utf-8"))
+        finally:
+            self._slots.release()
+
+    def stream_json(self, path: str, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> Any:
+        """Yield each ``data:`` JSON object of a server-sent-events response (OpenAI ``stream: true``).
+
+        The concurrency slot is held until the generator finishes; a consumer that
+        stops early closes the connection instead of returning it half-read.
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise UpstreamBusyError("too many concurrent upstream requests")
+        conn = None
+        done = False
+        try:
+            conn, resp = self._open(path, payload, {"Accept": "text/event-stream", **(headers or {})})
+            while True:
+                line = resp.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                yield json.loads(data.decode("utf-8"))
+            self._finish(conn, resp)
+            done = True
+        finally:
+            if conn is not None and not done:
+                conn.close()
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "base_url": f"{self.scheme}://{self.host}{':' + str(self.port) if self.port else ''}{self.base_path}",
+                "requests": self.requests,
+                "retries": self.retries,
+                "connections": self.connections,
+                "idle": len(self._idle),
+            }
+
+
+_llm_client = PooledHTTPClient(LLM_BASE_URL, LLM_TIMEOUT, LLM_MAX_CONCURRENCY, LLM_QUEUE_TIMEOUT,
+                               LLM_MAX_RETRIES, LLM_BACKOFF)
+
+
+def _llm_api_key() -> Optional[str]:
+    return os.environ.get("DEEPSEEK_API_KEY") or os.environ.get("OPENAI_API_KEY")
+
+
+def _chat_payload(system_msg: str, user_msg: str, stream: bool = False, max_tokens: int = 300,
+                  json_mode: bool = False) -> Dict[str, Any]:
     payload = {
-        "model": "deepseek-chat",
+        "model": LLM_MODEL,
         "messages": [
             {"role": "system", "content": system_msg},
             {"role": "user", "content": user_msg},
         ],
-        "max_tokens": 300,
+        "max_tokens": max_tokens,
         "temperature": 0.7,
     }
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(url, data=data, method="POST")
-    req.add_header("Content-Type", "application/json")
-    req.add_header("Authorization", f"Bearer {api_key}")
+    if stream:
+        payload["stream"] = True
+    if json_mode:
+        payload["response_format"] = {"type": "json_object"}
+    return payload
+
+
+def _upstream_error(e: Exception) -> str:
+    return f"busy: {e}" if isinstance(e, UpstreamBusyError) else str(e)
+
+
+def _call_deepseek_chat(system_msg: str, user_msg: str, **options: Any) -> Dict[str, Any]:
+    api_key = _llm_api_key()
+    if not api_key:
+        return {"error": "API key not configured. Set DEEPSEEK_API_KEY."}
     try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            body = resp.read()
-            j = json.loads(body.decode("utf-8"))
-            # OpenAI兼容返回结构
-            try:
-                content = j["choices"][0]["message"]["content"].strip()
-            except Exception:
-                content = None
-            return {"content": content, "raw": j}
-    except urllib.error.HTTPError as e:
+        j = _llm_client.post_json("/chat/completions", _chat_payload(system_msg, user_msg, **options),
+                                  {"Authorization": f"Bearer {api_key}"})
+        # OpenAI兼容返回结构
         try:
-            err_body = e.read().decode("utf-8")
+            content = j["choices"][0]["message"]["content"].strip()
         except Exception:
-            err_body = str(e)
-        return {"error": f"HTTP {e.code}: {err_body}"}
+            content = None
+        return {"content": content, "raw": j}
     except Exception as e:
-        return {"error": str(e)}
+        return {"error": _upstream_error(e)}
 
 
-@app.post("/api/ai_analysis")
-def ai_analysis():
-    data = request.get_json(force=True, silent=True) or {}
-    symbol = str(data.get("symbol", "")).upper().strip()
-    fin = data.get("financial_data") or {}
-    # 兼容字段名
-    current_price = fin.get("currentPrice")
-    change_percent = fin.get("changePercent")
-    pe_ratio = fin.get("peRatio")
-    rsi14 = fin.get("rsi14")
+def _stream_deepseek_chat(system_msg: str, user_msg: str) -> Any:
+    """Yield content deltas of a streamed completion; raises on missing key or upstream errors."""
+    api_key = _llm_api_key()
+    if not api_key:
+        raise RuntimeError("API key not configured. Set DEEPSEEK_API_KEY.")
+    chunks = _llm_client.stream_json("/chat/completions", _chat_payload(system_msg, user_msg, stream=True),
+                                     {"Authorization": f"Bearer {api_key}"})
+    for chunk in chunks:
+        try:
+            delta = chunk["choices"][0]["delta"].get("content")
+        except Exception:
+            delta = None
+        if delta:
+            yield delta
+
+
+AI_CACHE_TTL = float(os.environ.get("AI_CACHE_TTL", 900))
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", 2048))
+_ai_cache = TTLCache(AI_CACHE_TTL, AI_CACHE_SIZE, name="ai_analysis")
+_AI_PE_BANDS = (0, 10, 15, 20, 25, 30, 40, 60, 100)
 
-    prompt = (
+
+def _finite(x: Any) -> Optional[float]:
+    try:
+        v = float(x)
+    except (TypeError, ValueError):
+        return None
+    return v if math.isfinite(v) else None
+
+
+def _ai_cache_key(symbol: str, change_percent: Any, pe_ratio: Any, rsi14: Any) -> Tuple[Any, ...]:
+    """Symbol plus coarse input bands; requests falling into the same bands share one analysis."""
+    chg, rsi, pe = _finite(change_percent), _finite(rsi14), _finite(pe_ratio)
+    return (
+        symbol,
+        None if chg is None else int(min(max(math.floor(chg), -10), 10)),  # 1% 一档，±10% 以外合并
+        None if rsi is None else int(min(max(rsi, 0.0), 99.9) // 5),       # 5 点一档
+        None if pe is None else int(np.searchsorted(_AI_PE_BANDS, pe, side="right")),
+    )
+
+
+def _ai_prompt(symbol: str, current_price: Any, change_percent: Any, pe_ratio: Any, rsi14: Any) -> str:
+    return (
         f"As an investment advisor, analyze {symbol}:\n\n"
         f"Current price: ${current_price}\n"
         f"Change: {change_percent}%\n"
@@ -726,81 +3203,299 @@ def ai_analysis():
         "3. Actionable suggestion\n\n"
         "Requirements: professional yet easy to understand, within 150 words."
     )
-    sys_msg = "You are a professional financial analyst who explains complex concepts in plain English."
-    result = _call_deepseek_chat(sys_msg, prompt)
+
+
+AI_SYSTEM_MSG = "You are a professional financial analyst who explains complex concepts in plain English."
+
+
+def _ai_inputs(fin: Dict[str, Any]) -> Tuple[Any, Any, Any, Any]:
+    # 兼容字段名
+    return fin.get("currentPrice"), fin.get("changePercent"), fin.get("peRatio"), fin.get("rsi14")
+
+
+def _ai_fallback(symbol: str, analysis: str, err: str) -> Dict[str, Any]:
+    # 余额不足时降级到本地简化分析，返回200并携带warning
+    if "HTTP 402" in err or "Insufficient Balance" in err:
+        return {"symbol": symbol, "analysis": analysis, "warning": "insufficient_balance", "source": "local"}
+    # 其他错误：仍尝试返回本地简化分析，携带通用warning
+    return {"symbol": symbol, "analysis": analysis, "warning": "fallback", "source": "local", "error": err}
+
+
+def _ai_analysis_result(symbol: str, fin: Dict[str, Any]) -> Dict[str, Any]:
+    """Analysis payload for one symbol: cached/coalesced LLM answer, or the local fallback on error."""
+    current_price, change_percent, pe_ratio, rsi14 = _ai_inputs(fin)
+    called = []
+
+    def load() -> Dict[str, Any]:
+        called.append(True)
+        return _call_deepseek_chat(AI_SYSTEM_MSG, _ai_prompt(symbol, current_price, change_percent, pe_ratio, rsi14))
+
+    # 相同代码 + 相近输入命中缓存；并发的相同请求共享一次上游调用
+    result = _ai_cache.get_or_set(_ai_cache_key(symbol, change_percent, pe_ratio, rsi14), load,
+                                  lambda r: not r.get("error") and bool(r.get("content")))
     if result.get("error"):
-        err = str(result.get("error"))
-        # 余额不足时降级到本地简化分析，返回200并携带warning
-        if "HTTP 402" in err or "Insufficient Balance" in err:
-            analysis = _local_ai_analysis(symbol, current_price, change_percent, pe_ratio, rsi14)
-            return jsonify({"symbol": symbol, "analysis": analysis, "warning": "insufficient_balance", "source": "local"})
-        # 其他错误：仍尝试返回本地简化分析，携带通用warning
         analysis = _local_ai_analysis(symbol, current_price, change_percent, pe_ratio, rsi14)
-        return jsonify({"symbol": symbol, "analysis": analysis, "warning": "fallback", "source": "local", "error": err})
-    return jsonify({"symbol": symbol, "analysis": result.get("content"), "source": "deepseek"})
+        return _ai_fallback(symbol, analysis, str(result.get("error")))
+    return {"symbol": symbol, "analysis": result.get("content"), "source": "deepseek", "cached": not called}
+
+
+class StreamFlight:
+    """One upstream streaming completion whose deltas are replayed to every subscriber.
+
+    The producer runs on its own thread, so it finishes (and fills the cache)
+    even if the client that started it disconnects.
+    """
+
+    def __init__(self):
+        self.deltas: List[str] = []
+        self.error: Optional[str] = None
+        self.finished = False
+        self._cond = threading.Condition()
+
+    def push(self, delta: str) -> None:
+        with self._cond:
+            self.deltas.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, error: Optional[str] = None) -> None:
+        with self._cond:
+            self.error = error
+            self.finished = True
+            self._cond.notify_all()
+
+    def follow(self, timeout: float) -> Any:
+        """Yield every delta from the start; raises TimeoutError if the producer stalls."""
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self.deltas) and not self.finished:
+                    if not self._cond.wait(timeout):
+                        raise TimeoutError("upstream stream stalled")
+                batch = self.deltas[i:]
+                finished = self.finished
+            i += len(batch)
+            yield from batch
+            if finished and i >= len(self.deltas):
+                return
+
+
+_ai_stream_flights: Dict[Any, StreamFlight] = {}
+_ai_stream_lock = threading.Lock()
+
+
+def _ai_stream_join(key: Any, prompt: str) -> Tuple[Optional[Dict[str, Any]], Optional[StreamFlight]]:
+    """Cached answer for ``key``, or the in-flight stream for it (starting one if none is running)."""
+    with _ai_stream_lock:
+        # 缓存写入先于登记表移除，因此在锁内复查缓存即可避免重复发起上游请求
+        cached = _ai_cache.get(key)
+        if cached is not None:
+            return cached, None
+        flight = _ai_stream_flights.get(key)
+        if flight is not None:
+            return None, flight
+        flight = _ai_stream_flights[key] = StreamFlight()
+
+    def produce() -> None:
+        parts = []
+        try:
+            for delta in _stream_deepseek_chat(AI_SYSTEM_MSG, prompt):
+                parts.append(delta)
+                flight.push(delta)
+            content = "".join(parts).strip()
+            if content:
+                _ai_cache.set(key, {"content": content})
+            flight.finish(None if content else "empty response")
+        except Exception as e:
+            flight.finish(_upstream_error(e))
+        finally:
+            with _ai_stream_lock:
+                _ai_stream_flights.pop(key, None)
+
+    threading.Thread(target=produce, name="ai-stream", daemon=True).start()
+    return None, flight
+
+
+def _ai_analysis_stream(symbol: str, fin: Dict[str, Any]) -> Any:
+    """SSE events: the local analysis as ``placeholder`` right away, then ``delta`` chunks, then ``done``.
+
+    Concurrent identical requests (same cache key) share one upstream stream.
+    """
+    current_price, change_percent, pe_ratio, rsi14 = _ai_inputs(fin)
+    local = _local_ai_analysis(symbol, current_price, change_percent, pe_ratio, rsi14)
+    yield _sse("placeholder", {"symbol": symbol, "analysis": local, "source": "local"})
+    key = _ai_cache_key(symbol, change_percent, pe_ratio, rsi14)
+    cached, flight = _ai_stream_join(key, _ai_prompt(symbol, current_price, change_percent, pe_ratio, rsi14))
+    if flight is None:
+        yield _sse("done", {"symbol": symbol, "analysis": cached.get("content"), "source": "deepseek", "cached": True})
+        return
+    try:
+        for delta in flight.follow(LLM_TIMEOUT + LLM_QUEUE_TIMEOUT):
+            yield _sse("delta", {"text": delta})
+    except TimeoutError as e:
+        yield _sse("done", _ai_fallback(symbol, local, str(e)))
+        return
+    if flight.error:
+        yield _sse("done", _ai_fallback(symbol, local, flight.error))
+        return
+    content = "".join(flight.deltas).strip()
+    yield _sse("done", {"symbol": symbol, "analysis": content, "source": "deepseek", "cached": False})
 
 
-def _local_ai_analysis(symbol: str, current_price: Any, change_percent: Any, pe_ratio: Any, rsi14: Any) -> str:
-    """Simplified local analysis based on basic indicators, about 150 words."""
+@app.post("/api/ai_analysis")
+def ai_analysis():
+    data = request.get_json(force=True, silent=True) or {}
+    symbol = str(data.get("symbol", "")).upper().strip()
+    fin = data.get("financial_data") or {}
+    if data.get("stream") or request.args.get("stream") in ("1", "true"):
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return Response(stream_with_context(_ai_analysis_stream(symbol, fin)), mimetype="text/event-stream",
+                        headers=headers)
+    return jsonify(_ai_analysis_result(symbol, fin))
+
+
+AI_BATCH_SIZE = int(os.environ.get("AI_BATCH_SIZE", 10))
+AI_BATCH_MAX_SYMBOLS = int(os.environ.get("AI_BATCH_MAX_SYMBOLS", 50))
+AI_BATCH_TOKENS_PER_SYMBOL = 120
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm-batch")
+
+
+def _ai_batch_prompt(items: List[Tuple[str, Dict[str, Any]]]) -> str:
+    lines = []
+    for symbol, fin in items:
+        price, chg, pe, rsi = _ai_inputs(fin)
+        lines.append(f"- {symbol}: price ${price}, change {chg}%, P/E {pe if pe is not None else 'N/A'}, "
+                     f"RSI {rsi if rsi is not None else 'N/A'}")
+    return (
+        "As an investment advisor, analyze each of these stocks:\n\n" + "\n".join(lines) + "\n\n"
+        "For each stock give a concise recommendation covering technical analysis, risk warnings and an "
+        "actionable suggestion, within 80 words, professional yet easy to understand.\n"
+        "Respond with a JSON object mapping each ticker symbol exactly as given to its analysis string."
+    )
+
+
+def _parse_batch_analyses(content: Optional[str]) -> Dict[str, str]:
+    """Ticker -> analysis from a JSON answer; tolerates code fences and {"analysis": ...} values."""
+    text = (content or "").strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("{"):] if "{" in text else text
     try:
-        price = current_price
-        chg = change_percent
-        pe = pe_ratio
-        rsi = rsi14
-        parts = []
-        # 技术面
-        tech = []
-        if rsi is not None:
-            try:
-                r = float(rsi)
-                if r <= 30:
-                    tech.append("RSI low; strong oversold conditions")
-                elif r >= 70:
-                    tech.append("RSI high; overbought risk")
+        parsed = json.loads(text[:text.rfind("}") + 1] if "}" in text else text)
+    except ValueError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    out = {}
+    for sym, value in parsed.items():
+        if isinstance(value, dict):
+            value = value.get("analysis")
+        if isinstance(value, str) and value.strip():
+            out[str(sym).upper().strip()] = value.strip()
+    return out
+
+
+def _ai_batch_group(items: List[Tuple[str, Dict[str, Any]]]) -> Tuple[Dict[str, str], Optional[str]]:
+    """One LLM round trip for a group of symbols; returns parsed analyses and the upstream error, if any."""
+    result = _call_deepseek_chat(AI_SYSTEM_MSG, _ai_batch_prompt(items),
+                                 max_tokens=AI_BATCH_TOKENS_PER_SYMBOL * len(items) + 50, json_mode=True)
+    if result.get("error"):
+        return {}, str(result["error"])
+    return _parse_batch_analyses(result.get("content")), None
+
+
+def _batch_financial_data(symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+    """financial_data for symbols the client sent without metrics, from cached quotes and company profiles."""
+    quotes = {q["symbol"]: q for q in _get_prices_for_symbols(symbols)}
+    basics = _fetch_company_basics(symbols)
+    return {
+        sym: {
+            "currentPrice": quotes.get(sym, {}).get("price"),
+            "changePercent": quotes.get(sym, {}).get("change_percent"),
+            "peRatio": basics.get(sym, {}).get("pe"),
+            "rsi14": (quotes.get(sym, {}).get("indicators") or {}).get("rsi14"),
+        }
+        for sym in symbols
+    }
+
+
+@app.post("/api/ai_analysis/batch")
+def ai_analysis_batch():
+    data = request.get_json(force=True, silent=True) or {}
+    items: Dict[str, Dict[str, Any]] = {}
+    for entry in data.get("items") or []:
+        if isinstance(entry, dict) and str(entry.get("symbol", "")).strip():
+            items[str(entry["symbol"]).upper().strip()] = entry.get("financial_data") or {}
+    for sym in _request_symbols(data):
+        items.setdefault(sym, {})
+    if not items:
+        return jsonify({"ok": False, "error": "symbols are required"}), 400
+    if len(items) > AI_BATCH_MAX_SYMBOLS:
+        return jsonify({"ok": False, "error": f"at most {AI_BATCH_MAX_SYMBOLS} symbols per batch"}), 400
+    try:
+        bare = [sym for sym, fin in items.items() if not fin]
+        if bare:
+            items.update(_batch_financial_data(bare))
+
+        results: Dict[str, Dict[str, Any]] = {}
+        keys = {sym: _ai_cache_key(sym, *_ai_inputs(fin)[1:]) for sym, fin in items.items()}
+        pending = []
+        for sym, fin in items.items():
+            cached = _ai_cache.get(keys[sym])
+            if cached is not None:
+                results[sym] = {"symbol": sym, "analysis": cached.get("content"), "source": "deepseek", "cached": True}
+            else:
+                pending.append((sym, fin))
+
+        # 未命中的代码按组合并成结构化提示词，各组并发请求（受连接池并发上限约束）
+        groups = [pending[i:i + AI_BATCH_SIZE] for i in range(0, len(pending), AI_BATCH_SIZE)]
+        for group, fut in zip(groups, [_llm_executor.submit(_ai_batch_group, g) for g in groups]):
+            analyses, err = fut.result()
+            for sym, fin in group:
+                content = analyses.get(sym)
+                if content:
+                    _ai_cache.set(keys[sym], {"content": content})
+                    results[sym] = {"symbol": sym, "analysis": content, "source": "deepseek", "cached": False}
                 else:
-                    tech.append("RSI neutral")
-            except Exception:
-                tech.append("RSI data limited")
-        if chg is not None:
-            try:
-                c = float(chg)
-                if c >= 2:
-                    tech.append("Short-term upward momentum is strong")
-                elif c <= -2:
-                    tech.append("Short-term pullback pressure is notable")
-            except Exception:
-                pass
-        if tech:
-            parts.append("Technical: " + ", ".join(tech))
-        # 风险
-        risk = []
-        if pe is not None:
-            try:
-                p = float(pe)
-                if p >= 30:
-                    risk.append("Valuation is high; volatility may amplify")
-                elif p <= 10:
-                    risk.append("Valuation is low; fundamentals need confirmation")
-            except Exception:
-                pass
-        risk.append("Mind event risk and market environment")
-        parts.append("Risk: " + ", ".join(risk))
-        # 操作建议
-        op = []
+                    price, chg, pe, rsi = _ai_inputs(fin)
+                    local = _local_ai_analysis(sym, price, chg, pe, rsi)
+                    results[sym] = _ai_fallback(sym, local, err or "missing from batch response")
+        return jsonify({
+            "ok": True,
+            "results": [results[sym] for sym in items],
+            "llm_calls": len(groups),
+        })
+    except Exception as e:
+        return jsonify({"ok": False, "error": "ai_analysis_batch_failed", "detail": str(e)}), 500
+
+
+def _local_ai_analysis(symbol: str, current_price: Any, change_percent: Any, pe_ratio: Any, rsi14: Any) -> str:
+    """Local analysis text from the signal rule table (instant fallback when the LLM is unavailable).
+
+    Inputs are parsed with float() like the original branches: +/-inf compare
+    as numbers, NaN RSI reads as neutral, other NaN or unparseable values fire no rule.
+    """
+    def parse(x: Any) -> Optional[float]:
         try:
-            r = float(rsi) if rsi is not None else None
-            if r is not None and r <= 30:
-                op.append("Start with a small position; scale in gradually")
-            elif r is not None and r >= 70:
-                op.append("Trim positions cautiously; wait for a pullback")
-            else:
-                op.append("Stay on the sidelines; watch support and volume")
-        except Exception:
-            op.append("Prioritize risk control; set stop-loss levels")
-        parts.append("Action: " + ", ".join(op))
-        text = "; ".join(parts)
-        # 控制长度
-        return text[:160]
+            return float(x)
+        except (TypeError, ValueError):
+            return None
+
+    def column(x: Any) -> np.ndarray:
+        v = parse(x)
+        return np.array([np.nan if v is None else v])
+
+    try:
+        rsi = parse(rsi14)
+        columns = {
+            "price": column(current_price),
+            "change_percent": column(change_percent),
+            "pe": column(pe_ratio),
+            # NaN RSI 既不超买也不超卖，与旧版分支一样按中性处理
+            "rsi14": column(50.0 if rsi is not None and np.isnan(rsi) else rsi14),
+            # 客户端传了 RSI 但无法解析
+            "rsi_invalid": np.array([float(rsi14 is not None and rsi is None)]),
+        }
+        return _signal_texts(_evaluate_signal_rules(columns))[0]
     except Exception:
         return "Limited data; consider waiting and manage risk."
 
@@ -812,4 +3507,9 @@ def index():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    # debug 模式下只在 reloader 子进程里预热，避免父进程重复拉取
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        _quote_refresher.start()
+        _screener.start()
+        _sector_analytics.start()
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
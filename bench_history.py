@@ -0,0 +1,86 @@
+"""Benchmark /api/history serialization on a synthetic 10k-bar payload.
+
+Compares the previous per-element path (pd.isna + float per value, per-row
+Timestamp conversion, stdlib json) with the vectorized _history_payload +
+_json_response path. No network access is needed.
+
+    python bench_history.py [bars] [repeats]
+"""
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def make_frame(bars: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    idx = pd.date_range("2024-01-02 09:30", periods=bars, freq="1min", tz="America/New_York")
+    close = 100 + np.cumsum(rng.normal(0, 0.05, bars))
+    return pd.DataFrame({
+        "Open": close + rng.normal(0, 0.02, bars),
+        "High": close + 0.1,
+        "Low": close - 0.1,
+        "Close": close,
+        "Volume": rng.integers(1_000, 50_000, bars).astype(float),
+    }, index=idx)
+
+
+def legacy_serialize(sym: str, df: pd.DataFrame) -> bytes:
+    df = df.dropna()
+    ts = [int(pd.Timestamp(i).timestamp() * 1000) for i in df.index]
+    ind = {k: v[0] for k, v in app._indicator_arrays(df["Close"].to_numpy(dtype=float)).items()}
+
+    def to_list(series):
+        out = []
+        for v in series:
+            if pd.isna(v) or v is None:
+                out.append(None)
+            else:
+                out.append(float(v))
+        return out
+
+    payload = {
+        "symbol": sym,
+        "ts": ts,
+        "open": to_list(df["Open"]),
+        "high": to_list(df["High"]),
+        "low": to_list(df["Low"]),
+        "close": to_list(df["Close"]),
+        "volume": to_list(df["Volume"]),
+        "indicators": {k: to_list(v) for k, v in ind.items()},
+    }
+    return json.dumps(payload).encode("utf-8")
+
+
+def fast_serialize(sym: str, df: pd.DataFrame) -> bytes:
+    with app.app.app_context():
+        return app._json_response(app._history_payload(sym, df)).get_data()
+
+
+def best_of(fn, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> None:
+    bars = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    df = make_frame(bars)
+    legacy = best_of(lambda: legacy_serialize("BENCH", df), repeats)
+    fast = best_of(lambda: fast_serialize("BENCH", df), repeats)
+    encoder = "orjson" if app.orjson is not None else "stdlib json"
+    print(f"bars={bars} encoder={encoder}")
+    print(f"legacy: {legacy * 1000:.1f} ms")
+    print(f"fast:   {fast * 1000:.1f} ms  ({legacy / fast:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()